@@ -38,43 +38,52 @@ def get_ansible_cmd(
     return list(itertools.chain(*ansible_command_filtered))
 
 
+def get_ansible_playbook_cmd(
+    vault_pass_file,
+    extra_vars,
+    tags,
+    playbook_path,
+    inventory,
+    connection,
+    start_at_task=None,
+):
+    """Creates the `ansible-playbook` command that `ansible-pull` would run
+
+    It is run from the root of the checked out Git repository.
+    """
+    ansible_command_filtered = filter(
+        None,
+        [
+            ["ansible-playbook"],
+            ["--inventory", inventory] if inventory else [],
+            ["--vault-password-file", vault_pass_file] if vault_pass_file else [],
+            ["--extra-vars", extra_vars] if extra_vars else [],
+            ["--connection", connection] if connection else [],
+            ["--tags", tags] if tags else [],
+            ["--start-at-task", start_at_task] if start_at_task else [],
+            [playbook_path],
+        ],
+    )
+
+    # Flatten
+    return list(itertools.chain(*ansible_command_filtered))
+
+
 def get_ansible_result(ansible_log):
     """Creates a play recap message from the one matched in the Ansible log"""
     m_git_result = re.search(pattern_git_result, ansible_log)
     m_play_recap = re.search(pattern_play_recap, ansible_log)
     m_play_failure = re.search(pattern_play_failure, ansible_log)
+    m_task_not_found = re.search(pattern_start_at_task_not_found, ansible_log)
 
     result = dict()
 
     if m_git_result:
         grp = m_git_result.group
-        success = True if str(grp("result")).lower().startswith("success") else False
-        result["success"] = success
-
-        parse_error = None
-        json_dict = dict()
-        try:
-            json_dict = json.loads(str(grp("json")))
-        except ValueError as e:
-            parse_error = "(Failed to parse Ansible Git result JSON: %s)" % e
-
-        success = True if json_dict.get("failed") == "true" else False
-        changed = True if json_dict.get("changed") == "true" else False
-        before = json_dict.get("before")
-        after = json_dict.get("after")
-        msg = json_dict.get("msg")
-
-        result["git_result"] = {
-            "host": grp("host"),
-            "success": success,
-            "changed": changed,
-            "before": before,
-            "after": after,
-            "msg": clean_json_msg(msg),
-        }
-
-        if parse_error:
-            result["git_result"]["parse_error"] = parse_error
+        result["success"] = is_success_result(grp("result"))
+        result["git_result"] = parse_git_result(
+            grp("host"), grp("result"), str(grp("json"))
+        )
 
     if m_play_failure:
         grp = m_play_failure.group
@@ -94,6 +103,9 @@ def get_ansible_result(ansible_log):
             "exception": grp("task_exception"),
         }
 
+    if m_task_not_found:
+        result["start_at_task_not_found"] = m_task_not_found.group("task")
+
     if m_play_recap:
         grp = m_play_recap.group
 
@@ -108,6 +120,99 @@ def get_ansible_result(ansible_log):
     return result
 
 
+def is_success_result(result):
+    return str(result).lower().startswith("success")
+
+
+def parse_git_result(host, result, json_text):
+    """Creates the Git result from the JSON printed by the Ansible Git module"""
+    parse_error = None
+    json_dict = dict()
+    try:
+        json_dict = json.loads(json_text)
+    except ValueError as e:
+        parse_error = "(Failed to parse Ansible Git result JSON: %s)" % e
+
+    git_result = {
+        "host": host,
+        "success": is_success_result(result) and not json_dict.get("failed"),
+        "changed": bool(json_dict.get("changed")),
+        "before": json_dict.get("before"),
+        "after": json_dict.get("after"),
+        "msg": clean_json_msg(json_dict.get("msg")),
+    }
+
+    if parse_error:
+        git_result["parse_error"] = parse_error
+
+    return git_result
+
+
+class GitResultWatcher:
+    """Recognizes the Git module result as soon as its JSON block is output
+
+    Feed it the Ansible Pull output line by line, and it returns the Git result
+    once the block has been completed, so a failed checkout can be acted upon
+    without waiting for the `ansible-pull` process to exit.
+    """
+
+    def __init__(self):
+        self.git_result = None
+        self._header = None
+        self._json_lines = []
+
+    def feed(self, line):
+        if self.git_result is not None:
+            return None
+
+        if self._header is None:
+            m = re.match(pattern_git_result_header, line)
+            if m:
+                self._header = m.group("host", "result")
+                self._json_lines = [m.group("json_start")]
+                return self._parse_if_complete(m.group("json_start"))
+            return None
+
+        self._json_lines.append(line)
+        return self._parse_if_complete(line)
+
+    def _parse_if_complete(self, line):
+        if not line.rstrip().endswith("}"):
+            return None
+
+        json_text = "\n".join(self._json_lines)
+        try:
+            json.loads(json_text)
+        except ValueError:
+            # A nested object was closed, keep reading the block
+            return None
+
+        self.git_result = parse_git_result(*self._header, json_text)
+        return self.git_result
+
+
+def get_git_failure_type(ansible_result):
+    """Returns "checkout" or "download" if the Git module failed, or None"""
+    git_result = ansible_result.get("git_result")
+
+    if git_result and not git_result["success"] and git_result.get("msg"):
+        match = re.search(pattern_git_failure, git_result["msg"])
+        if match:
+            return match.group("failure")
+
+    return None
+
+
+def get_task_name(line):
+    """Returns the name of the task if the line starts one, or None"""
+    if line.startswith(task_header_prefixes):
+        m = re.match(pattern_task_header, line)
+        if m:
+            return m.group("task")
+
+    return None
+
+
 def clean_json_msg(msg):
     return msg.replace("\n", "\\n") if msg else msg
 
@@ -135,3 +240,20 @@ pattern_git_result = re.compile(
     + r"\s+=>\s+(?P<json>{\s*\n(:?.*\n)*\s*}\s*$)",
     flags=re.MULTILINE,
 )
+
+pattern_git_result_header = re.compile(
+    r"^(?P<host>\w+) \| (?P<result>\w+!?)\s+=>\s+(?P<json_start>{.*?)\s*$"
+)
+
+# Output by `ansible-playbook` instead of running anything, when the task of
+# `--start-at-task` isn't in the playbook
+pattern_start_at_task_not_found = re.compile(
+    r'^(?:\[ERROR\]: |ERROR! )?No matching task "(?P<task>.*)" found',
+    flags=re.MULTILINE,
+)
+
+pattern_git_failure = re.compile(r"^Failed to (?P<failure>checkout|download)\b")
+
+task_header_prefixes = ("TASK ", "RUNNING HANDLER ")
+
+pattern_task_header = re.compile(r"^(?:TASK|RUNNING HANDLER)\s+\[(?P<task>[^\]]+)\]")
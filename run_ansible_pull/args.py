@@ -2,6 +2,17 @@ import argparse
 import os
 import sys
 
+from run_ansible_pull.logger import LOG_FORMAT_TEXT, log_formats
+from run_ansible_pull.resume import path_resume_state_file, resume_max
+from run_ansible_pull.retry import default_retry_on, failure_classes
+from run_ansible_pull.sensu import (
+    path_sensu_state_file,
+    sensu_heartbeat,
+    sensu_host,
+    sensu_port,
+)
+from run_ansible_pull.system import path_lock_file
+
 
 def get_args():
     parser = argparse.ArgumentParser(description="Runs Ansible Pull.")
@@ -106,7 +117,7 @@ def get_args():
         action=store_expand_home_dir_alias,
         type=str,
         default=None,
-        help="The branch to check out." + "[None]",
+        help="The branch, tag or commit to check out." + "[None]",
     )
 
     parser.add_argument(
@@ -139,6 +150,20 @@ def get_args():
         help="The file to log to. " + "[stdout]",
     )
 
+    parser.add_argument(
+        "--log-format",
+        dest="log_format",
+        action="store",
+        type=str,
+        choices=log_formats,
+        default=LOG_FORMAT_TEXT,
+        help=(
+            "The format of log records: `json` writes one JSON object per line,"
+            + " with the run ID, attempt, phase, source, task and PID."
+            + f" [{LOG_FORMAT_TEXT}]"
+        ),
+    )
+
     parser.add_argument(
         "--only-if-changed",
         dest="only_if_changed",
@@ -147,6 +172,50 @@ def get_args():
         help="Only run the playbook if the repository has been updated. [False]",
     )
 
+    parser.add_argument(
+        "--direct",
+        dest="direct",
+        action="store_true",
+        default=False,
+        help=(
+            "Check out the Git repository with Git and run `ansible-playbook`"
+            + " directly, instead of through `ansible-pull`. [False]"
+        ),
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        default=False,
+        help=(
+            "Start at the task that failed or timed out in the last run, if the"
+            + " commit hasn't changed since, or the whole playbook if the task"
+            + " isn't found. Requires --direct. [False]"
+        ),
+    )
+
+    parser.add_argument(
+        "--resume-max",
+        dest="resume_max",
+        action="store",
+        default=resume_max,
+        type=int,
+        help=(
+            "The number of resumes in a row before running the whole playbook"
+            + f" again. [{resume_max}]"
+        ),
+    )
+
+    parser.add_argument(
+        "--resume-state-file",
+        dest="resume_state_file",
+        action=store_expand_home_dir_alias,
+        type=str,
+        default=path_resume_state_file,
+        help=f"The file storing the task to resume at. [{path_resume_state_file}]",
+    )
+
     parser.add_argument(
         "--tags",
         dest="tags",
@@ -156,6 +225,136 @@ def get_args():
         help="The tags to send to Ansible. " + "[None]",
     )
 
+    parser.add_argument(
+        "--tag-group",
+        dest="tag_groups",
+        action="append",
+        type=str,
+        default=None,
+        help=(
+            "Comma-separated tags of a group of tasks that doesn't depend on the"
+            + " other groups. Repeat it for each group: the groups are run"
+            + " concurrently after the prologue, each with its own timeout."
+            + " Requires --prologue-tags. [None]"
+        ),
+    )
+
+    parser.add_argument(
+        "--prologue-tags",
+        dest="prologue_tags",
+        action="store",
+        type=str,
+        default=None,
+        help=(
+            "The tags to run first, checking out the repository, before the tag"
+            + " groups. [None]"
+        ),
+    )
+
+    parser.add_argument(
+        "--max-parallel",
+        dest="max_parallel",
+        action="store",
+        default=4,
+        type=int,
+        help="The maximum number of tag groups to run at a time. [4]",
+    )
+
+    parser.add_argument(
+        "--failure-rules",
+        dest="failure_rules",
+        action=store_expand_home_dir_alias,
+        type=str,
+        default=None,
+        help=(
+            "The YAML file of known failure rules to match against the output."
+            + " [/etc/run-ansible-pull/failure-rules.yaml, or the built-in rules]"
+        ),
+    )
+
+    parser.add_argument(
+        "--fallback-branch",
+        dest="fallback_branch",
+        action="store",
+        type=str,
+        default="master",
+        help=(
+            "The branch to retry with when Git fails to check out the branch,"
+            + " or an empty string to retry the same branch. [master]"
+        ),
+    )
+
+    parser.add_argument(
+        "--max-attempts",
+        dest="max_attempts",
+        action="store",
+        default=2,
+        type=int,
+        help="The maximum number of Ansible Pull attempts per run. [2]",
+    )
+
+    parser.add_argument(
+        "--retry-backoff",
+        dest="retry_backoff",
+        action="store",
+        default=2.0,
+        type=float,
+        help="Seconds to wait before the first retry, doubled for each retry. [2]",
+    )
+
+    parser.add_argument(
+        "--retry-backoff-max",
+        dest="retry_backoff_max",
+        action="store",
+        default=60.0,
+        type=float,
+        help="The maximum number of seconds to wait between retries. [60]",
+    )
+
+    parser.add_argument(
+        "--retry-jitter",
+        dest="retry_jitter",
+        action="store",
+        default=0.5,
+        type=float,
+        help="The fraction of the backoff to randomly subtract, 0 to 1. [0.5]",
+    )
+
+    parser.add_argument(
+        "--retry-budget",
+        dest="retry_budget",
+        action="store",
+        default=None,
+        type=float,
+        help="Don't start retries later than this many seconds into the run. [None]",
+    )
+
+    parser.add_argument(
+        "--retry-on",
+        dest="retry_on",
+        action="store",
+        type=lambda value: [x.strip() for x in value.split(",") if x.strip()],
+        default=list(default_retry_on),
+        help=(
+            "Comma-separated failure classes to retry, out of: %s,"
+            " or a class given in the failure rules. [%s]"
+        )
+        % (", ".join(failure_classes), ",".join(default_retry_on)),
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        dest="metrics_file",
+        action=store_expand_home_dir_alias,
+        type=str,
+        default=None,
+        help=(
+            "The node-exporter textfile to write run metrics to, for example:"
+            + " /var/lib/node_exporter/textfile_collector/run_ansible_pull.prom."
+            + " [None]"
+        ),
+    )
+
     parser.add_argument(
         "--notify-sensu",
         dest="notify_sensu",
@@ -164,4 +363,71 @@ def get_args():
         help="Specify whether to notify Sensu or not. " + "[False]",
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--sensu-host",
+        dest="sensu_host",
+        action="store",
+        type=str,
+        default=sensu_host,
+        help=f"The host of the Sensu client socket. [{sensu_host}]",
+    )
+
+    parser.add_argument(
+        "--sensu-port",
+        dest="sensu_port",
+        action="store",
+        type=int,
+        default=sensu_port,
+        help=f"The port of the Sensu client socket. [{sensu_port}]",
+    )
+
+    parser.add_argument(
+        "--sensu-heartbeat",
+        dest="sensu_heartbeat",
+        action="store",
+        type=int,
+        default=sensu_heartbeat,
+        help=(
+            "Only send Sensu events when the status or summary changes, or after"
+            + " this many seconds, which must be shorter than the TTL of the"
+            + f" check. 0 sends an event every run. [{sensu_heartbeat}]"
+        ),
+    )
+
+    parser.add_argument(
+        "--sensu-state-file",
+        dest="sensu_state_file",
+        action=store_expand_home_dir_alias,
+        type=str,
+        default=path_sensu_state_file,
+        help=(
+            "The file storing the last Sensu event sent, or an empty string to"
+            + f" send an event every run. [{path_sensu_state_file}]"
+        ),
+    )
+
+    parser.add_argument(
+        "--lock-file",
+        dest="lock_file",
+        action=store_expand_home_dir_alias,
+        type=str,
+        default=path_lock_file,
+        help=f"The lock file ensuring a single running instance. [{path_lock_file}]",
+    )
+
+    args = parser.parse_args()
+
+    if args.resume and not args.direct:
+        parser.error("--resume requires --direct, `ansible-pull` can't start at a task")
+
+    if args.tag_groups:
+        if not args.prologue_tags:
+            parser.error("--tag-group requires --prologue-tags")
+        if args.tags:
+            parser.error("--tags can't be used with --tag-group")
+        if args.resume:
+            parser.error("--resume can't be used with --tag-group")
+        if args.max_parallel < 1:
+            parser.error("--max-parallel must be at least 1")
+
+    return args
@@ -1,10 +1,13 @@
 import logging
+import os
 
 from run_ansible_pull.logger import logger_label
+from run_ansible_pull.rules import path_default_failure_rules
 
 path_config = "/etc/run-ansible-pull"
 path_git_branch = f"{path_config}/git-branch.txt"
 path_git_branch_override = f"{path_config}/git-branch_override.txt"
+path_failure_rules = f"{path_config}/failure-rules.yaml"
 
 logger = logging.getLogger(logger_label)
 
@@ -48,3 +51,14 @@ def get_git_branch(branch=None):
         git_branch = branch
 
     return git_branch
+
+
+def get_failure_rules_path(path=None):
+    if path is None:
+        if os.path.exists(path_failure_rules):
+            path = path_failure_rules
+        else:
+            path = path_default_failure_rules
+        logger.info("Using failure rules from file: '%s'", path)
+
+    return path
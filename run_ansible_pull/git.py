@@ -0,0 +1,168 @@
+import logging
+import os
+import re
+import subprocess
+
+from run_ansible_pull.ansible import clean_json_msg
+from run_ansible_pull.logger import logger_label
+
+logger = logging.getLogger(logger_label)
+
+
+class GitError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def run_git(args, work_dir, env, timeout):
+    cmd = ["git", "-C", work_dir] + args
+    logger.info("Running Git command: %s", " ".join(cmd))
+
+    try:
+        completed = subprocess.run(
+            cmd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        raise GitError("Timed out after %s seconds: %s" % (timeout, " ".join(cmd)))
+    except OSError as e:
+        raise GitError("Failed to run: %s: %s" % (" ".join(cmd), e))
+
+    for line in completed.stdout.splitlines():
+        logger.info(line)
+
+    if completed.returncode != 0:
+        raise GitError(completed.stdout)
+
+    return completed.stdout.strip()
+
+
+def get_git_env(accept_host_key):
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+
+    if accept_host_key and "GIT_SSH_COMMAND" not in env:
+        env["GIT_SSH_COMMAND"] = "ssh -o StrictHostKeyChecking=no"
+
+    return env
+
+
+def get_head(work_dir, env, timeout):
+    try:
+        return run_git(
+            ["rev-parse", "--verify", "--quiet", "HEAD"], work_dir, env, timeout
+        )
+    except GitError:
+        return None
+
+
+def get_commit_time(work_dir, commit="HEAD"):
+    """Returns the commit time as a Unix timestamp, or None if it's unknown"""
+    try:
+        output = subprocess.check_output(
+            ["git", "-C", work_dir, "show", "--no-patch", "--format=%ct", commit],
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            timeout=10,
+        )
+        return float(output.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def get_remote_refs(work_dir, ref, env, timeout):
+    """Returns the names of the branch and tag named `ref` on the remote"""
+    output = run_git(
+        ["ls-remote", "origin", "refs/heads/%s" % ref, "refs/tags/%s" % ref],
+        work_dir,
+        env,
+        timeout,
+    )
+    return set(line.split("\t")[-1] for line in output.splitlines())
+
+
+def checkout_git_repo(work_dir, repo_url, branch, timeout, accept_host_key=True):
+    """Checks out the branch, tag or commit of the repository into the work dir
+
+    Does what the Git module does when run by `ansible-pull`, and returns a
+    result with the same structure as `ansible.parse_git_result`, with
+    messages that classify failures the same way: a remote that can't be
+    reached is a download failure, and a ref it doesn't have is a checkout
+    failure, so that the fallback branch applies.
+
+    The remote is asked for a branch, then a tag, named `branch`. A commit
+    hash needs all branches and tags fetched, to find the commit in them.
+    """
+    env = get_git_env(accept_host_key)
+
+    git_result = {
+        "host": "localhost",
+        "success": False,
+        "changed": False,
+        "before": None,
+        "after": None,
+        "msg": None,
+    }
+
+    try:
+        if os.path.isdir(os.path.join(work_dir, ".git")):
+            before = get_head(work_dir, env, timeout)
+            git_result.update(before=before, after=before)
+            run_git(["remote", "set-url", "origin", repo_url], work_dir, env, timeout)
+        else:
+            os.makedirs(work_dir, exist_ok=True)
+            run_git(["init", "--quiet"], work_dir, env, timeout)
+            run_git(["remote", "add", "origin", repo_url], work_dir, env, timeout)
+
+        remote_refs = get_remote_refs(work_dir, branch, env, timeout)
+        if "refs/heads/%s" % branch in remote_refs:
+            remote_ref = "refs/remotes/origin/%s" % branch
+            refspecs = ["+refs/heads/%s:%s" % (branch, remote_ref)]
+            checkout = ["-B", branch, remote_ref]
+        elif "refs/tags/%s" % branch in remote_refs:
+            refspecs = ["+refs/tags/%s:refs/tags/%s" % (branch, branch)]
+            checkout = ["--detach", "refs/tags/%s" % branch]
+        elif re.match(pattern_commit_hash, branch):
+            refspecs = [
+                "+refs/heads/*:refs/remotes/origin/*",
+                "+refs/tags/*:refs/tags/*",
+            ]
+            checkout = ["--detach", branch]
+        else:
+            git_result["msg"] = clean_json_msg(
+                "Failed to checkout %s: no branch, tag or commit named %s in %s"
+                % (branch, branch, repo_url)
+            )
+            return git_result
+
+        run_git(["fetch", "--force", "origin"] + refspecs, work_dir, env, timeout)
+    except (GitError, OSError) as e:
+        git_result["msg"] = clean_json_msg(
+            "Failed to download remote objects and refs:  %s" % e
+        )
+        return git_result
+
+    try:
+        run_git(["checkout", "--force"] + checkout, work_dir, env, timeout)
+        if os.path.exists(os.path.join(work_dir, ".gitmodules")):
+            run_git(
+                ["submodule", "update", "--init", "--recursive"], work_dir, env, timeout
+            )
+    except GitError as e:
+        git_result["msg"] = clean_json_msg("Failed to checkout %s: %s" % (branch, e))
+        return git_result
+
+    after = get_head(work_dir, env, timeout)
+
+    git_result.update(success=True, changed=git_result["before"] != after, after=after)
+
+    return git_result
+
+
+pattern_commit_hash = re.compile(r"^[0-9a-fA-F]{7,40}$")
@@ -0,0 +1,118 @@
+import logging
+import threading
+
+from run_ansible_pull.logger import logger_label
+from run_ansible_pull.sensu import format_sensu_summary
+from run_ansible_pull.system import kill_softly
+
+recap_counts = ["ok_count", "changed_count", "unreachable_count", "failed_count"]
+
+logger = logging.getLogger(logger_label)
+
+
+class RunningProcesses:
+    """Tracks the Ansible processes of tag groups, to stop them all on shutdown
+
+    A process added after `stop()` is stopped right away, so that a group
+    starting while the others are being stopped can't be left running.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._stopping = False
+
+    def add(self, process):
+        with self._lock:
+            self._processes.add(process)
+            stopping = self._stopping
+
+        if stopping:
+            kill_softly(process)
+
+    def discard(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            processes = list(self._processes)
+
+        for process in processes:
+            kill_softly(process)
+
+
+def merge_play_recaps(play_recaps):
+    """Adds up the counts of the Play recaps, or returns None if there are none"""
+    play_recaps = [x for x in play_recaps if x]
+    if not play_recaps:
+        return None
+
+    play_recap = dict(play_recaps[0])
+    for count in recap_counts:
+        play_recap[count] = sum(x[count] for x in play_recaps)
+
+    return play_recap
+
+
+def merge_group_attempts(prologue, group_attempts, runtime, ansible_seconds):
+    """Merges the prologue and tag group attempts into one attempt of the run
+
+    The merged attempt fails with the return code of the first failed group,
+    and its result has the Git result of the prologue, the first Play failure,
+    every known failure and the total of the Play recaps.
+    """
+    attempts = [prologue] + [attempt for _tags, attempt in group_attempts]
+    results = [attempt["ansible_result"] for attempt in attempts]
+    return_codes = [attempt["return_code"] for attempt in attempts]
+
+    ansible_result = {
+        "git_result": prologue["ansible_result"].get("git_result"),
+        "rule_matches": [x for result in results for x in result["rule_matches"]],
+    }
+
+    play_recap = merge_play_recaps(result.get("play_recap") for result in results)
+    if play_recap:
+        ansible_result["play_recap"] = play_recap
+
+    play_failures = [
+        result["play_failure"]
+        for result in results
+        if result.get("play_failure")
+        and result.get("play_recap")
+        and result["play_recap"]["failed_count"] > 0
+    ]
+    if play_failures:
+        ansible_result["play_failure"] = play_failures[0]
+
+    return {
+        "return_code": next((x for x in return_codes if x != 0), 0),
+        "timed_out": any(attempt["timed_out"] for attempt in attempts),
+        "git_failure_type": prologue["git_failure_type"],
+        "runtime": runtime,
+        "ansible_seconds": ansible_seconds,
+        "ansible_result": ansible_result,
+        "last_task": None,
+        "group_attempts": group_attempts,
+    }
+
+
+def format_groups_summary(group_attempts):
+    """Formats one summary line per tag group"""
+    lines = []
+
+    for tags, attempt in group_attempts or []:
+        if attempt["timed_out"]:
+            status = "timeout"
+        elif attempt["return_code"] == 0:
+            status = "success"
+        else:
+            status = "failed"
+
+        summary = format_sensu_summary(attempt["ansible_result"], attempt["runtime"])
+        lines.append(
+            "Tag group [%s]: [%s] %s" % (tags, status, summary.replace("\n", "; "))
+        )
+
+    return "\n".join(lines)
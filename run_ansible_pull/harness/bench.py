@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Measures the wrapper end to end against a fake `ansible-pull`
+
+Runs offline: `ansible-pull` is replaced by `fake_ansible_pull` and Sensu by
+a local `FakeSensuServer`. Run with:
+
+    python -m run_ansible_pull.harness.bench [--iterations N] [scenario ...]
+
+With `--rules`, measures matching the lines of a recorded log against the
+built-in failure rules padded with made-up ones instead, for growing numbers
+of rules.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import timeit
+
+import yaml
+
+from run_ansible_pull.harness.runner import run_wrapper
+from run_ansible_pull.rules import (
+    FailureMatcher,
+    FailureRule,
+    load_failure_rules,
+    path_default_failure_rules,
+)
+from run_ansible_pull.sensu import SENSU_WARNING
+
+rule_counts = [5, 20, 80]
+
+
+def load_recorded_log(index=2):
+    test_data_path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data.yaml"
+    )
+    with open(test_data_path) as f:
+        return yaml.safe_load(f)["ansible_pull_logs"][index]["log"]
+
+
+def get_scenarios():
+    """Returns the scenarios by name, as (scenario, run_wrapper kwargs)"""
+    return {
+        "replay": ({"log": load_recorded_log()}, {}),
+        "paced": ({"lines": 500, "rate": 1000}, {}),
+        "flood": ({"lines": 50000, "line_size": 200}, {}),
+        "invalid-utf8": ({"lines": 100, "invalid_utf8": True}, {}),
+        "git-failure": (
+            {"git_failure": ["download"], "git_failure_hang": 30},
+            {"wrapper_args": ["--retry-backoff", "0"]},
+        ),
+        "timeout": ({"hang": 60}, {"wrapper_args": ["--timeout", "2"]}),
+        "children": ({"children": 3, "lines": 100}, {}),
+        "shutdown": (
+            {"hang": 60, "children": 2},
+            {"terminate_after": 1, "expected_events": 0},
+        ),
+        "shutdown-stubborn": (
+            {"hang": 60, "ignore_sigterm": True},
+            {"terminate_after": 1, "expected_events": 0},
+        ),
+    }
+
+
+def format_seconds(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return "-"
+    return "%.3f" % statistics.median(values)
+
+
+def print_table(columns, rows):
+    widths = [
+        max(len(str(row[i])) for row in [columns] + rows) for i in range(len(columns))
+    ]
+    for row in [columns] + rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+def run_benchmark(names, iterations, timeout):
+    scenarios = get_scenarios()
+    columns = [
+        "scenario",
+        "latency",
+        "tail delay",
+        "shutdown",
+        "events",
+        "status",
+        "hung",
+    ]
+    rows = []
+
+    for name in names:
+        scenario, kwargs = scenarios[name]
+        results = [
+            run_wrapper(scenario, timeout=timeout, **kwargs) for _ in range(iterations)
+        ]
+        rows.append(
+            [
+                name,
+                format_seconds(r["latency"] for r in results),
+                format_seconds(r["tail_delay"] for r in results),
+                format_seconds(r["shutdown_time"] for r in results),
+                "%.1f" % statistics.mean(len(r["events"]) for r in results),
+                ",".join(
+                    sorted(set(str(e["status"]) for r in results for e in r["events"]))
+                )
+                or "-",
+                "%s/%s" % (sum(r["timed_out"] for r in results), len(results)),
+            ]
+        )
+
+    print_table(columns, rows)
+
+
+def get_padded_rules(count):
+    """Returns the built-in failure rules and made-up ones, `count` in all"""
+    rules = load_failure_rules(path_default_failure_rules).rules
+    return rules + [
+        FailureRule(
+            "made-up-%d" % i,
+            r"Error %d: (?:unable|failed) to \w+ service" % i,
+            SENSU_WARNING,
+            "sensu",
+        )
+        for i in range(count - len(rules))
+    ]
+
+
+def run_rules_benchmark(counts, iterations):
+    lines = load_recorded_log().splitlines()
+    columns = ["rules", "us/line", "matched"]
+    rows = []
+
+    for count in counts:
+        matcher = FailureMatcher(get_padded_rules(count))
+        seconds = min(
+            timeit.repeat(
+                lambda: [matcher.match(line) for line in lines],
+                number=100,
+                repeat=iterations,
+            )
+        )
+        rows.append(
+            [
+                len(matcher.rules),
+                "%.2f" % (seconds / 100 / len(lines) * 1e6),
+                sum(matcher.match(line) is not None for line in lines),
+            ]
+        )
+
+    print_table(columns, rows)
+
+
+def main():
+    scenario_names = list(get_scenarios())
+
+    parser = argparse.ArgumentParser(
+        description="Measures the wrapper end to end against a fake ansible-pull."
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help="The scenarios to run, out of: %s. [all]" % ", ".join(scenario_names),
+    )
+    parser.add_argument(
+        "--iterations",
+        dest="iterations",
+        action="store",
+        type=int,
+        default=3,
+        help="The number of runs per scenario, reporting medians. [3]",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        action="store",
+        type=float,
+        default=60,
+        help="Seconds before a hung wrapper is killed. [60]",
+    )
+    parser.add_argument(
+        "--rules",
+        dest="rules",
+        action="store_true",
+        help="Measure matching output lines against %s failure rules instead."
+        % ", ".join(map(str, rule_counts)),
+    )
+    args = parser.parse_args()
+
+    if args.rules:
+        run_rules_benchmark(rule_counts, args.iterations)
+        return
+
+    unknown_scenarios = set(args.scenarios) - set(scenario_names)
+    if unknown_scenarios:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown_scenarios)))
+
+    run_benchmark(args.scenarios or scenario_names, args.iterations, args.timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
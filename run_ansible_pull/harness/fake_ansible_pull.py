@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""A stand-in for `ansible-pull` and `ansible-playbook` that plays back a scenario
+
+`ansible-playbook`, named by the `FAKE_ANSIBLE_COMMAND` environment variable,
+doesn't output a Git result.
+
+The scenario is a JSON file named by the `FAKE_ANSIBLE_PULL_SCENARIO`
+environment variable, with the keys:
+
+    log:           Output to replay, line by line, instead of a successful
+                   Git result.
+    lines:         Number of synthetic task lines to output after the log.
+    line_size:     Length of each synthetic line. [80]
+    rate:          Lines per second, or 0 for as fast as possible. [0]
+    git_failure:   "checkout" or "download" to output a failed Git result
+                   first, or a list of them to fail only the first attempts.
+    git_failure_hang: Seconds to sleep right after a failed Git result, like a
+                   doomed run waiting on slow inventories or plugins. [0]
+    invalid_utf8:  Output a line of bytes that aren't valid UTF-8. [false]
+    children:      Number of child processes to fork, which inherit stdout
+                   and sleep until they are terminated. [0]
+    hang:          Seconds to sleep after the output, before exiting. [0]
+    tags_hang:     Seconds to hang instead, by `--tags` value.
+    ignore_sigterm: Ignore SIGTERM, so it has to be killed. [false]
+    recap:         Output a Play recap, counting the synthetic lines as ok
+                   tasks. [false]
+    failed_tags:   `--tags` values to fail a task with, and exit with 2.
+    start_at_task_not_found: Output only that the task of `--start-at-task`
+                   isn't found, if it's given, and exit with 0. [false]
+    return_code:   The exit status. [0]
+    argv_file:     File to append the command line arguments to, as JSON.
+    exit_file:     File to write the time of exit to.
+    attempt_file:  File counting the attempts, for `git_failure` lists.
+
+Like `ansible-pull`, it creates the `--directory` it checks out into.
+"""
+
+import json
+import os
+import signal
+import sys
+import time
+
+git_failure_messages = {
+    "checkout": "Failed to checkout some-branch",
+    "download": "Failed to download remote objects and refs:  fatal: Couldn't"
+    + " find remote ref refs/heads/some-branch\\n",
+}
+
+
+def load_scenario():
+    with open(os.environ["FAKE_ANSIBLE_PULL_SCENARIO"]) as f:
+        return json.load(f)
+
+
+def next_attempt(scenario):
+    attempt_file = scenario.get("attempt_file")
+    if not attempt_file:
+        return 1
+
+    attempt = 1
+    if os.path.exists(attempt_file):
+        with open(attempt_file) as f:
+            attempt = int(f.read() or 0) + 1
+
+    with open(attempt_file, "w") as f:
+        f.write(str(attempt))
+
+    return attempt
+
+
+def get_git_failure(scenario, attempt):
+    git_failure = scenario.get("git_failure")
+
+    if isinstance(git_failure, list):
+        return git_failure[attempt - 1] if attempt <= len(git_failure) else None
+
+    return git_failure
+
+
+def git_result_lines(git_failure):
+    if git_failure:
+        return [
+            "localhost | FAILED! => {",
+            '    "changed": false,',
+            '    "failed": true,',
+            '    "msg": "%s"' % git_failure_messages[git_failure],
+            "}",
+        ]
+
+    return [
+        "localhost | SUCCESS => {",
+        '    "after": "3ac4dbd946a19c42f97acc22c8c73badf84c15c0",',
+        '    "before": "3ac4dbd946a19c42f97acc22c8c73badf84c15c0",',
+        '    "changed": false',
+        "}",
+    ]
+
+
+def synthetic_lines(count, line_size):
+    for number in range(count):
+        line = "TASK [synthetic : task %s] " % number
+        yield line + "*" * max(0, line_size - len(line))
+
+
+def get_option(name):
+    argv = sys.argv[1:]
+    return argv[argv.index(name) + 1] if name in argv[:-1] else None
+
+
+def recap_lines(ok_count, failed_count):
+    return [
+        "",
+        "PLAY RECAP " + "*" * 69,
+        "localhost                  : ok=%s    changed=0    unreachable=0    failed=%s"
+        % (ok_count, failed_count),
+    ]
+
+
+def fork_children(count):
+    for _ in range(count):
+        if os.fork() == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            time.sleep(3600)
+            os._exit(0)
+
+
+def write_line(out, line):
+    out.write(line if isinstance(line, bytes) else line.encode() + b"\n")
+    out.flush()
+
+
+def run():
+    scenario = load_scenario()
+    attempt = next_attempt(scenario)
+    out = sys.stdout.buffer
+
+    if scenario.get("argv_file"):
+        with open(scenario["argv_file"], "a") as f:
+            f.write(json.dumps(sys.argv[1:]) + "\n")
+
+    if scenario.get("ignore_sigterm"):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    fork_children(scenario.get("children", 0))
+
+    rate = scenario.get("rate", 0)
+    interval = 1.0 / rate if rate else 0
+
+    lines = ["Starting Ansible Pull at %s" % time.strftime("%Y-%m-%d %H:%M:%S")]
+    start_at_task = get_option("--start-at-task")
+    if start_at_task and scenario.get("start_at_task_not_found"):
+        write_line(
+            out,
+            '[ERROR]: No matching task "%s" found. Note: --start-at-task can only'
+            " follow static includes." % start_at_task,
+        )
+        return 0
+
+    git_failure = get_git_failure(scenario, attempt)
+    if os.environ.get("FAKE_ANSIBLE_COMMAND", "ansible-pull") != "ansible-pull":
+        git_failure = None
+    else:
+        if git_failure or not scenario.get("log"):
+            lines += git_result_lines(git_failure)
+        if not git_failure and get_option("--directory"):
+            os.makedirs(get_option("--directory"), exist_ok=True)
+    lines += scenario.get("log", "").splitlines()
+
+    if interval:
+        for line in lines:
+            write_line(out, line)
+            time.sleep(interval)
+    else:
+        # In one write, so that it's read as one chunk if it's small enough
+        write_line(out, "\n".join(lines))
+
+    if git_failure and scenario.get("git_failure_hang"):
+        time.sleep(scenario["git_failure_hang"])
+
+    if scenario.get("invalid_utf8"):
+        write_line(out, b"Module output: \xff\xfe invalid \xc3\x28 bytes\n")
+
+    line_count, line_size = scenario.get("lines", 0), scenario.get("line_size", 80)
+    for line in synthetic_lines(line_count, line_size):
+        write_line(out, line)
+        if interval:
+            time.sleep(interval)
+
+    failed = get_option("--tags") in scenario.get("failed_tags", [])
+    if failed:
+        for line in [
+            "TASK [%s : fail] " % get_option("--tags") + "*" * 40,
+            'fatal: [localhost]: FAILED! => {"changed": false, "msg": "Failed"}',
+        ]:
+            write_line(out, line)
+
+    if scenario.get("recap") or failed:
+        for line in recap_lines(line_count, int(failed)):
+            write_line(out, line)
+
+    hang = scenario.get("tags_hang", {}).get(get_option("--tags"), scenario.get("hang"))
+    if hang:
+        time.sleep(hang)
+
+    if scenario.get("exit_file"):
+        with open(scenario["exit_file"], "w") as f:
+            f.write(repr(time.time()))
+
+    return 2 if git_failure or failed else scenario.get("return_code", 0)
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,66 @@
+import json
+import socketserver
+import threading
+import time
+
+
+class FakeSensuServer:
+    """A local TCP server impersonating the Sensu client socket
+
+    Events sent by `send_sensu_event` are parsed and kept in `events`, along
+    with the time they were received. Port 0 picks a free port, so that runs
+    don't depend on port 3030 being available.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.events = []
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(
+            (host, port), self._make_handler()
+        )
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        server._add_event(json.loads(line.decode()))
+
+        return Handler
+
+    def _add_event(self, event):
+        with self._lock:
+            self.events.append(dict(event, received_at=time.time()))
+
+    def wait_for_events(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if len(self.events) >= count:
+                    break
+            time.sleep(0.01)
+
+        with self._lock:
+            return list(self.events)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,207 @@
+import json
+import os
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from run_ansible_pull.harness.fake_sensu import FakeSensuServer
+
+package_root = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+fake_executables = ["ansible-pull", "ansible-playbook"]
+
+
+def make_bin_dir(tmp_dir):
+    """Creates a directory of fake Ansible executables to put first in PATH"""
+    bin_dir = os.path.join(tmp_dir, "bin")
+    os.makedirs(bin_dir)
+
+    for name in fake_executables:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(
+                "#!/bin/sh\nFAKE_ANSIBLE_COMMAND=%s exec %s"
+                ' -m run_ansible_pull.harness.fake_ansible_pull "$@"\n'
+                % (name, sys.executable)
+            )
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    return bin_dir
+
+
+def make_git_repo(path, branch="master"):
+    """Creates a Git repository with a playbook, for the `--direct` mode"""
+    git = ["git", "-c", "user.name=harness", "-c", "user.email=harness@localhost"]
+
+    os.makedirs(path)
+    subprocess.check_call(git + ["init", "--quiet", path])
+    subprocess.check_call(git + ["-C", path, "checkout", "--quiet", "-b", branch])
+
+    with open(os.path.join(path, "playbook.yaml"), "w") as f:
+        f.write("- hosts: all\n  tasks: []\n")
+
+    subprocess.check_call(git + ["-C", path, "add", "playbook.yaml"])
+    subprocess.check_call(git + ["-C", path, "commit", "--quiet", "-m", "Playbook"])
+
+    return "file://%s" % path
+
+
+def read_float(path):
+    try:
+        with open(path) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def read_json_lines(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def run_wrapper(
+    scenario,
+    wrapper_args=(),
+    terminate_after=None,
+    expected_events=1,
+    timeout=120,
+    git_repo_url="file:///dev/null",
+    triggers_after=(),
+):
+    """Runs the wrapper against a fake `ansible-pull` and a fake Sensu server
+
+    Returns a dict with the wrapper's return code and output, the Sensu events
+    received, the commands the fake was run with, and the timings:
+
+        latency:       Seconds from starting the wrapper until it exited.
+        tail_delay:    Seconds from the fake `ansible-pull` exiting until the
+                       wrapper exited, if it exited on its own.
+        shutdown_time: Seconds from sending SIGTERM until the wrapper exited,
+                       if `terminate_after` was given.
+
+    If the wrapper doesn't exit within `timeout` seconds, its whole process
+    group is killed and `timed_out` is set in the result.
+
+    For each of `triggers_after`, another wrapper is started that many seconds
+    after the previous one, contending for the same lock, and its return code
+    is added to `trigger_return_codes`.
+    """
+    with tempfile.TemporaryDirectory(prefix="run-ansible-pull-harness-") as tmp_dir:
+        with FakeSensuServer() as sensu:
+            paths = {
+                key: os.path.join(tmp_dir, name)
+                for key, name in [
+                    ("scenario", "scenario.json"),
+                    ("exit_file", "exit-time.txt"),
+                    ("attempt_file", "attempts.txt"),
+                    ("argv_file", "argv.jsonl"),
+                    ("home", "home"),
+                    ("work_dir", "work"),
+                ]
+            }
+            os.makedirs(paths["home"])
+
+            with open(paths["scenario"], "w") as f:
+                json.dump(
+                    dict(
+                        scenario,
+                        exit_file=paths["exit_file"],
+                        attempt_file=paths["attempt_file"],
+                        argv_file=paths["argv_file"],
+                    ),
+                    f,
+                )
+
+            env = dict(
+                os.environ,
+                PATH=os.pathsep.join([make_bin_dir(tmp_dir), os.environ["PATH"]]),
+                HOME=paths["home"],
+                PYTHONPATH=os.pathsep.join(
+                    filter(None, [package_root, os.environ.get("PYTHONPATH")])
+                ),
+                FAKE_ANSIBLE_PULL_SCENARIO=paths["scenario"],
+            )
+
+            cmd = [
+                sys.executable,
+                "-m",
+                "run_ansible_pull.main",
+                "--playbook-path",
+                "playbook.yaml",
+                "--git-repo-url",
+                git_repo_url,
+                "--checkout",
+                "master",
+                "--directory",
+                paths["work_dir"],
+                "--lock-file",
+                os.path.join(tmp_dir, "run-ansible-pull.lock"),
+                "--notify-sensu",
+                "--sensu-host",
+                sensu.host,
+                "--sensu-port",
+                str(sensu.port),
+                "--sensu-state-file",
+                os.path.join(tmp_dir, "sensu-state.json"),
+            ] + list(wrapper_args)
+
+            start_time = time.time()
+            process = subprocess.Popen(
+                cmd,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+            trigger_return_codes = []
+            for trigger_after in triggers_after:
+                time.sleep(trigger_after)
+                trigger = subprocess.run(
+                    cmd,
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=timeout,
+                )
+                trigger_return_codes.append(trigger.returncode)
+
+            terminate_time = None
+            if terminate_after is not None:
+                time.sleep(terminate_after)
+                terminate_time = time.time()
+                process.send_signal(signal.SIGTERM)
+
+            timed_out = False
+            try:
+                output, _ = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                os.killpg(process.pid, signal.SIGKILL)
+                output, _ = process.communicate()
+            end_time = time.time()
+
+            events = sensu.wait_for_events(expected_events, timeout=2)
+            exit_time = read_float(paths["exit_file"])
+
+            return {
+                "return_code": process.returncode,
+                "timed_out": timed_out,
+                "output": output.decode(errors="replace"),
+                "events": events,
+                "ansible_commands": read_json_lines(paths["argv_file"]),
+                "trigger_return_codes": trigger_return_codes,
+                "latency": end_time - start_time,
+                "tail_delay": end_time - exit_time if exit_time else None,
+                "shutdown_time": (
+                    end_time - terminate_time if terminate_time else None
+                ),
+            }
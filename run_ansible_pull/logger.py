@@ -1,5 +1,7 @@
+import json
 import logging
 import sys
+import time
 
 from cloghandler import ConcurrentRotatingFileHandler
 
@@ -7,8 +9,71 @@ logging.raiseExceptions = True
 logger_label = "run-ansible-pull"
 logger_labels = [logger_label, "tendo.singleton"]
 
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+log_formats = [LOG_FORMAT_TEXT, LOG_FORMAT_JSON]
 
-def set_logging_config(debug, log_file):
+SOURCE_WRAPPER = "wrapper"
+SOURCE_ANSIBLE = "ansible"
+
+# Passed as `extra` when logging a line of Ansible output
+ansible_log_extra = {"source": SOURCE_ANSIBLE}
+
+# What the wrapper is doing, added to every record in the JSON format
+log_context = {
+    "run_id": None,
+    "attempt": None,
+    "phase": None,
+    "task": None,
+}
+
+
+def set_log_context(**context):
+    log_context.update(context)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object, with the current log context
+
+    The output of concurrent tag groups carries its own task and tag group.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._encode = json.JSONEncoder(check_circular=False).encode
+        self._second = None
+        self._second_text = None
+
+    def _format_time(self, created):
+        # Formatting the time is the slowest part, so once per second will do
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._second_text = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        return "%s.%03dZ" % (self._second_text, (created - second) * 1000)
+
+    def format(self, record):
+        entry = {
+            "time": self._format_time(record.created),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "source": getattr(record, "source", SOURCE_WRAPPER),
+            "run_id": log_context["run_id"],
+            "attempt": log_context["attempt"],
+            "phase": log_context["phase"],
+            "task": getattr(record, "task", log_context["task"]),
+            "tag_group": getattr(record, "tag_group", None),
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return self._encode(entry)
+
+
+def set_logging_config(debug, log_file, log_format=LOG_FORMAT_TEXT):
     loggers = [logging.getLogger(label) for label in logger_labels]
 
     for logger in loggers:
@@ -23,8 +88,13 @@ def set_logging_config(debug, log_file):
                 )
             )
 
-        log_format = "%(asctime)s %(name)-10s %(process)6d %(levelname)-8s %(message)s"
+        if log_format == LOG_FORMAT_JSON:
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                "%(asctime)s %(name)-10s %(process)6d %(levelname)-8s %(message)s"
+            )
 
         for log_handler in log_handlers:
-            log_handler.setFormatter(logging.Formatter(log_format))
+            log_handler.setFormatter(formatter)
             logger.addHandler(log_handler)
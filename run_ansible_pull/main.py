@@ -1,26 +1,66 @@
 #!/usr/bin/env python3
+import argparse
 import logging
 import os
-import re
-import subprocess
 import time
 import shutil
 import sys
+import threading
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from multiprocessing import JoinableQueue, Process
+from multiprocessing import Process, Queue
 from queue import Empty
 
-from run_ansible_pull.ansible import get_ansible_cmd, get_ansible_result
+from run_ansible_pull.ansible import (
+    GitResultWatcher,
+    get_ansible_cmd,
+    get_ansible_playbook_cmd,
+    get_ansible_result,
+    get_git_failure_type,
+    get_task_name,
+)
 from run_ansible_pull.args import get_args
-from run_ansible_pull.config import get_git_branch
-from run_ansible_pull.logger import set_logging_config, logger_label
+from run_ansible_pull.config import get_git_branch, get_failure_rules_path
+from run_ansible_pull.git import checkout_git_repo, get_commit_time
+from run_ansible_pull.groups import (
+    RunningProcesses,
+    format_groups_summary,
+    merge_group_attempts,
+)
+from run_ansible_pull.logger import (
+    ansible_log_extra,
+    log_context,
+    logger_label,
+    set_log_context,
+    set_logging_config,
+)
+from run_ansible_pull.metrics import record_interrupt_metrics, record_run_metrics
+from run_ansible_pull.resume import (
+    clear_resume_state,
+    get_resume_task,
+    read_resume_state,
+    update_resume_state,
+)
+from run_ansible_pull.retry import (
+    RetryPolicy,
+    classify_failure,
+    format_attempts_summary,
+)
+from run_ansible_pull.rules import (
+    ACTION_DELETE_WORK_DIR,
+    RuleMatches,
+    load_failure_rules,
+    rule_actions_matched,
+    worst_rule_severity,
+)
 from run_ansible_pull.sensu import (
     SENSU_OK,
     SENSU_WARNING,
     SENSU_CRITICAL,
     format_sensu_summary,
-    send_sensu_event,
+    send_sensu_event_on_change,
 )
 from run_ansible_pull.system import (
     kill_softly,
@@ -29,237 +69,608 @@ from run_ansible_pull.system import (
     ShutdownException,
     subprocess_popen_pipe_output,
     instance_already_running,
+    PendingRuns,
 )
 
+read_chunk_size = 65536
+
+# Tag groups start processes from several threads. A reader forked while
+# another thread is starting Ansible would inherit the pipes of that process,
+# holding its output open and blocking `Popen` until the reader exits.
+process_start_lock = threading.Lock()
+
 logger = logging.getLogger(logger_label)
 
 
 def run():
     args = get_args()
-    set_logging_config(args.debug, args.log_file)
-    git_branch = get_git_branch()
-
-    if instance_already_running():
-        send_sensu_event(
-            status=SENSU_WARNING,
-            summary="Instance already running.",
-            enabled=args.notify_sensu,
-        )
-        logger.error("Instance already running, quitting.")
-        sys.exit(-1)
+    set_logging_config(args.debug, args.log_file, args.log_format)
+    failure_matcher = load_failure_rules(get_failure_rules_path(args.failure_rules))
+    pending_runs = PendingRuns(args.lock_file)
 
-    register_signal_handlers(logger)
+    # Fold triggers arriving mid-run into one follow-up run of that instance
+    if instance_already_running(args.lock_file) and pending_runs.request():
+        logger.info("Instance already running, requested it to run again after.")
+        sys.exit(0)
 
-    clean_tmp_dir()
+    pending_runs.clear()
 
-    return_code = -42
+    register_signal_handlers(logger)
 
-    first_run = True
-    try_again = False
+    clean_tmp_dir()
 
-    while first_run or try_again:
-        try_again = False
-        ansible_process = None
-        start_time = time.time()
+    try:
+        while True:
+            return_code = run_with_retries(args, failure_matcher)
 
-        try:
-            ansible_cmd = get_ansible_cmd(
-                args.work_dir,
-                args.git_repo_url,
-                args.vault_pass_file,
-                args.extra_vars,
-                args.tags,
-                args.only_if_changed,
-                args.playbook_path,
-                git_branch,
-                args.inventory,
-                args.connection,
-            )
-            logger.info("Running Ansible command: %s", " ".join(ansible_cmd))
-            ansible_process = subprocess_popen_pipe_output(ansible_cmd)
-            logger.info("Started Ansible process with PID: %s", ansible_process.pid)
+            if not pending_runs.consume():
+                break
 
-            queue = JoinableQueue()
-            logger_process = Process(
-                target=enqueue_output, args=(ansible_process.stdout, queue)
-            )
-            logger_process.start()
+            logger.info("Runs were requested while running, running again.")
+    except ShutdownException as e:
+        if args.metrics_file:
+            record_interrupt_metrics(args.metrics_file)
+        sys.exit(e.signal)
 
-            ansible_output = ""
-
-            class LoopEnder:
-                def __init__(self, _process, _start_time, _timeout):
-                    self._state_ansible_running = None
-                    self._state_time_elapsed = None
-                    self._state_remainder = None
-                    self._counter_remainder = list([True] * 20 + [False])
-                    self._process = _process
-                    self._start_time = _start_time
-                    self._timeout = _timeout
-
-                def keep_going(self):
-                    keep_going = (
-                        self._ansible_running() and not self._timeout_reached()
-                    ) or self._remainder()
-                    logger.debug("Keep going: %s", self)
-                    return keep_going
-
-                def __str__(self):
-                    return ", ".join(
-                        [
-                            f"start time: {self._start_time}",
-                            f"timeout: {self._timeout}",
-                            f"ansible running: {self._state_ansible_running}",
-                            f"time remaining: {self._timeout - self._state_time_elapsed}",
-                            f"remainder count: {len(list(filter(None, self._counter_remainder)))}",
-                        ]
-                    )
-
-                def _ansible_running(self):
-                    self._state_ansible_running = self._process.poll() is None
-                    return self._state_ansible_running
-
-                def _timeout_reached(self):
-                    self._state_time_elapsed = time.time() - self._start_time
-                    return self._state_time_elapsed > self._timeout
-
-                def _remainder(self):
-                    self._state_remainder = self._counter_remainder.pop(0)
-                    return self._state_remainder
-
-            loop_ender = LoopEnder(ansible_process, start_time, args.timeout)
-
-            while loop_ender.keep_going():
-                line, lines = "", []
-                try:
-                    while line is not None:
-                        logger.debug("queue size: %s", queue.qsize())
-                        line = queue.get(block=False)
-                        lines.append(line)
-                        queue.task_done()
-                        logger.debug(
-                            "got_from_queue: [%s]: %s", type(line), bytes(line, "utf8")
-                        )
-                except Empty:
-                    logger.debug("Queue: Empty exception caught.")
-                else:
-                    logger.debug("Queue: No exceptions caught.")
-
-                for line in lines:
-                    logger.info(line.rstrip())
-                    ansible_output += line
-                else:
-                    time.sleep(0.1)
+    sys.exit(return_code)
 
-            try:
-                stdout_output, error_data = ansible_process.communicate()
-                ansible_output += stdout_output
-                return_code = ansible_process.returncode
-            except subprocess.TimeoutExpired:
-                return_code = None
 
-        except ShutdownException as e:
-            logger.error(
-                "Ansible Pull result: Interrupted. PID[%s]", ansible_process.pid
-            )
-            kill_softly(ansible_process)
-            sys.exit(e.signal)
+def run_with_retries(args, failure_matcher):
+    """Runs Ansible until it succeeds or the retry policy gives up
+
+    Sends one Sensu event for all of the attempts, and returns the return
+    code of the last one.
+    """
+    set_log_context(run_id=uuid.uuid4().hex, attempt=None, phase=None, task=None)
+    git_branch = get_git_branch(args.branch)
+
+    retry_policy = RetryPolicy(
+        max_attempts=args.max_attempts,
+        backoff=args.retry_backoff,
+        backoff_max=args.retry_backoff_max,
+        jitter=args.retry_jitter,
+        time_budget=args.retry_budget,
+        retry_on=args.retry_on,
+    )
+
+    start_time = time.time()
+    backoff_seconds = 0.0
+    attempts = []
+    fell_back_to_branch = False
+
+    while True:
+        set_log_context(attempt=len(attempts) + 1, task=None)
+        if args.tag_groups:
+            attempt = run_tag_groups(args, git_branch, failure_matcher)
         else:
-            if return_code is None:
-                logger.error(
-                    "Ansible Pull result: Timeout (%s seconds). PID[%s]",
-                    args.timeout,
-                    ansible_process.pid,
-                )
-                kill_softly(ansible_process)
-            else:
-                logger.info(
-                    "Ansible Pull result: %s. PID[%s]. Return code: %s",
-                    "Success" if return_code == 0 else "Failed",
-                    ansible_process.pid,
-                    ansible_process.returncode,
-                )
-        finally:
-            end = time.time()
-            runtime = timedelta(seconds=int(end - start_time))
-
-        ansible_result = get_ansible_result(ansible_output)
+            attempt = run_attempt(args, git_branch, failure_matcher)
 
-        def get_git_failure_type(_ansible_result):
+        ansible_result = attempt["ansible_result"]
+        attempt["failure_class"] = classify_failure(attempt)
+        attempt["summary"] = format_sensu_summary(ansible_result, attempt["runtime"])
+        attempts.append(attempt)
 
-            git_failed_with_msg = (
-                _ansible_result.get("git_result")
-                and not _ansible_result["git_result"]["success"]
-                and _ansible_result["git_result"].get("msg")
-            )
+        delay = retry_policy.next_delay(
+            attempt["failure_class"], len(attempts), time.time() - start_time
+        )
+        if delay is None:
+            break
+
+        logger.warning(
+            "Attempt %s failed with: %s, trying again in %.1f seconds: %s",
+            len(attempts),
+            attempt["failure_class"],
+            delay,
+            attempt["summary"].replace("\n", "; "),
+        )
 
-            git_failure = None
+        if attempt["git_failure_type"] == "checkout" and args.fallback_branch:
+            git_branch = args.fallback_branch
+            fell_back_to_branch = True
 
-            if git_failed_with_msg:
-                regex_git_failure = re.compile(
-                    r"^Failed to (?P<failure>checkout|download)\\b"
-                )
-                match = re.search(
-                    regex_git_failure, _ansible_result["git_result"]["msg"]
+        matched_actions = rule_actions_matched(ansible_result["rule_matches"])
+        if attempt["git_failure_type"] or ACTION_DELETE_WORK_DIR in matched_actions:
+            if os.path.exists(args.work_dir):
+                logger.warning(
+                    'Deleting Git directory: "%s" because of failure: %s',
+                    args.work_dir,
+                    attempt["failure_class"],
                 )
-                git_failure = match.groups("failure")
+                shutil.rmtree(args.work_dir)
 
-            return git_failure
+        set_log_context(phase="backoff")
+        try:
+            time.sleep(delay)
+        except ShutdownException:
+            logger.error("Interrupted while waiting to try again.")
+            raise
+        backoff_seconds += delay
+
+    set_log_context(phase="report")
+    sensu_status = get_sensu_status(attempt, fell_back_to_branch)
+
+    # Report all attempts of the run in one event
+    resumed_at = attempt.get("start_at_task")
+    summary = "\n".join(
+        filter(
+            None,
+            [
+                attempt["summary"],
+                "Resumed at task: [%s]" % resumed_at if resumed_at else "",
+                format_groups_summary(attempt.get("group_attempts")),
+                format_attempts_summary(attempts),
+            ],
+        )
+    )
+    send_sensu_event_on_change(
+        status=sensu_status,
+        summary=summary,
+        state_path=args.sensu_state_file or None,
+        heartbeat=args.sensu_heartbeat,
+        enabled=args.notify_sensu,
+        host=args.sensu_host,
+        port=args.sensu_port,
+    )
+
+    if args.metrics_file:
+        duration = time.time() - start_time
+        ansible_seconds = sum(a["ansible_seconds"] for a in attempts)
+        git_result = ansible_result.get("git_result") or dict()
+        record_run_metrics(
+            args.metrics_file,
+            attempts,
+            duration,
+            duration - ansible_seconds - backoff_seconds,
+            get_commit_time(args.work_dir, git_result.get("after") or "HEAD"),
+        )
 
-        git_failure_type = get_git_failure_type(ansible_result)
+    return attempt["return_code"]
 
-        sensu_status = SENSU_OK if ansible_process.returncode == 0 else SENSU_CRITICAL
 
-        # Delete and try again if Git failed on the first run
-        if git_failure_type and first_run:
-            if git_failure_type == "checkout":
-                git_branch = "master"
+def get_sensu_status(attempt, fell_back_to_branch=False):
+    """Returns the Sensu status of the last attempt of a run
 
-            if os.path.exists(args.work_dir):
-                logger.warning(
-                    'Deleting Git directory: "%s" because Git failed to checkout branch',
-                    args.work_dir,
-                )
-                shutil.rmtree(args.work_dir)
-            sensu_status = SENSU_WARNING
-            try_again = True
+    A failed attempt gets the worst severity of the known failures it matched,
+    or critical if it matched none. A successful attempt is OK, since it may
+    have printed known failures from tasks whose errors are ignored.
+    """
+    if attempt["return_code"] == 0 and not attempt["timed_out"]:
+        sensu_status = SENSU_OK
+    else:
+        sensu_status = worst_rule_severity(
+            attempt["ansible_result"]["rule_matches"], SENSU_CRITICAL
+        )
 
-        summary = format_sensu_summary(ansible_result, runtime)
-        send_sensu_event(
-            status=sensu_status, summary=summary, enabled=args.notify_sensu
+    if fell_back_to_branch:
+        sensu_status = max(sensu_status, SENSU_WARNING)
+
+    return sensu_status
+
+
+def run_attempt(args, git_branch, failure_matcher):
+    """Runs the playbook once, through `ansible-pull` unless running directly"""
+    if args.direct:
+        return run_ansible_playbook_direct(args, git_branch, failure_matcher)
+
+    ansible_cmd = get_ansible_cmd(
+        args.work_dir,
+        args.git_repo_url,
+        args.vault_pass_file,
+        args.extra_vars,
+        args.tags,
+        args.only_if_changed,
+        args.playbook_path,
+        git_branch,
+        args.inventory,
+        args.connection,
+    )
+    return run_ansible(ansible_cmd, args.timeout, failure_matcher)
+
+
+def run_tag_groups(args, git_branch, failure_matcher):
+    """Runs the prologue, then the tag groups concurrently, as one attempt
+
+    The prologue checks out the repository and runs the prologue tags like a
+    normal attempt. The tag groups are then run with `ansible-playbook` from
+    the checked out repository, at most `max_parallel` of them at a time.
+    """
+    start_time = time.time()
+    prologue_args = argparse.Namespace(**dict(vars(args), tags=args.prologue_tags))
+    prologue = run_attempt(prologue_args, git_branch, failure_matcher)
+    git_result = prologue["ansible_result"].get("git_result")
+
+    if prologue["return_code"] != 0 or prologue["timed_out"]:
+        logger.error("Prologue failed, not running the tag groups.")
+        return prologue
+
+    if args.only_if_changed and git_result and not git_result["changed"]:
+        logger.info("Repository has not changed, not running the tag groups.")
+        return prologue
+
+    logger.info(
+        "Running %s tag groups, at most %s at a time: %s",
+        len(args.tag_groups),
+        args.max_parallel,
+        args.tag_groups,
+    )
+    groups_start_time = time.time()
+    processes = RunningProcesses()
+
+    with ThreadPoolExecutor(max_workers=args.max_parallel) as executor:
+        futures = [
+            executor.submit(run_tag_group, args, tags, failure_matcher, processes)
+            for tags in args.tag_groups
+        ]
+        try:
+            group_attempts = [
+                (tags, future.result())
+                for tags, future in zip(args.tag_groups, futures)
+            ]
+        except ShutdownException:
+            logger.error("Interrupted, stopping the tag groups.")
+            for future in futures:
+                future.cancel()
+            processes.stop()
+            raise
+
+    end = time.time()
+    return merge_group_attempts(
+        prologue,
+        group_attempts,
+        timedelta(seconds=int(end - start_time)),
+        prologue["ansible_seconds"] + end - groups_start_time,
+    )
+
+
+def run_tag_group(args, tags, failure_matcher, processes):
+    ansible_cmd = get_ansible_playbook_cmd(
+        args.vault_pass_file,
+        args.extra_vars,
+        tags,
+        args.playbook_path,
+        args.inventory,
+        args.connection,
+    )
+    return run_ansible(
+        ansible_cmd,
+        args.timeout,
+        failure_matcher,
+        cwd=args.work_dir,
+        tag_group=tags,
+        processes=processes,
+    )
+
+
+class LoopEnder:
+    def __init__(self, _process, _start_time, _timeout):
+        self._state_ansible_running = None
+        self._state_time_elapsed = None
+        self._state_output_ended = None
+        self.exit_time = None
+        self._state_remainder = None
+        self._counter_remainder = list([True] * 20 + [False])
+        self._process = _process
+        self._start_time = _start_time
+        self._timeout = _timeout
+
+    def keep_going(self, output_ended):
+        """Keeps going until Ansible exits or times out, and its output ends
+
+        Child processes may keep the output open after Ansible has exited, so
+        it is only read for a little while longer in that case.
+        """
+        self._state_output_ended = output_ended
+        if self._ansible_running():
+            keep_going = not self._timeout_reached()
+        else:
+            keep_going = not output_ended and self._remainder()
+        logger.debug("Keep going: %s", self)
+        return keep_going
+
+    def __str__(self):
+        return ", ".join(
+            [
+                f"start time: {self._start_time}",
+                f"timeout: {self._timeout}",
+                f"ansible running: {self._state_ansible_running}",
+                f"time elapsed: {self._state_time_elapsed}",
+                f"output ended: {self._state_output_ended}",
+                f"remainder count: {len(list(filter(None, self._counter_remainder)))}",
+            ]
         )
 
-        return_code = ansible_process.returncode
+    def _ansible_running(self):
+        self._state_ansible_running = self._process.poll() is None
+        if not self._state_ansible_running and self.exit_time is None:
+            self.exit_time = time.time()
+        return self._state_ansible_running
+
+    def _timeout_reached(self):
+        self._state_time_elapsed = time.time() - self._start_time
+        return self._state_time_elapsed > self._timeout
+
+    def _remainder(self):
+        self._state_remainder = self._counter_remainder.pop(0)
+        return self._state_remainder
+
+
+def run_ansible_playbook_direct(args, git_branch, failure_matcher):
+    """Checks out the repository with Git and runs `ansible-playbook` directly
+
+    This skips the two extra Ansible interpreter startups of `ansible-pull`,
+    one to run the Git module and one to exec `ansible-playbook`.
+    """
+    start_time = time.time()
+    set_log_context(phase="git")
+    git_result = checkout_git_repo(
+        args.work_dir, args.git_repo_url, git_branch, timeout=args.timeout
+    )
+    git_failure_type = get_git_failure_type({"git_result": git_result})
+
+    if not git_result["success"] or (
+        args.only_if_changed and not git_result["changed"]
+    ):
+        if git_result["success"]:
+            logger.info("Repository has not changed, not running the playbook.")
+        else:
+            logger.error("Git failed: %s", git_result["msg"])
+
+        return {
+            "return_code": 0 if git_result["success"] else 1,
+            "timed_out": False,
+            "git_failure_type": git_failure_type,
+            "runtime": timedelta(seconds=int(time.time() - start_time)),
+            "ansible_seconds": 0.0,
+            "ansible_result": {"git_result": git_result, "rule_matches": []},
+        }
+
+    resume_state = None
+    start_at_task = None
+    if args.resume:
+        resume_state = read_resume_state(args.resume_state_file)
+        start_at_task = get_resume_task(
+            resume_state,
+            git_result["after"],
+            args.playbook_path,
+            args.tags,
+            args.resume_max,
+        )
+        if start_at_task:
+            logger.info(
+                "Resuming the failed run of commit: %s at task: [%s]",
+                git_result["after"],
+                start_at_task,
+            )
 
-        first_run = False
+    def run_playbook(start_at_task):
+        ansible_cmd = get_ansible_playbook_cmd(
+            args.vault_pass_file,
+            args.extra_vars,
+            args.tags,
+            args.playbook_path,
+            args.inventory,
+            args.connection,
+            start_at_task,
+        )
+        return run_ansible(
+            ansible_cmd,
+            args.timeout - (time.time() - start_time),
+            failure_matcher,
+            cwd=args.work_dir,
+        )
 
-    sys.exit(return_code)
+    attempt = run_playbook(start_at_task)
 
+    # The task may have been renamed or be in a dynamic include, then
+    # `ansible-playbook` runs nothing and still succeeds
+    if start_at_task and attempt["ansible_result"].get("start_at_task_not_found"):
+        logger.warning(
+            "Task to resume at not found: [%s], running the whole playbook.",
+            start_at_task,
+        )
+        clear_resume_state(args.resume_state_file)
+        resume_state = start_at_task = None
+        ansible_seconds = attempt["ansible_seconds"]
+        attempt = run_playbook(None)
+        attempt["ansible_seconds"] += ansible_seconds
+
+    attempt["ansible_result"]["git_result"] = git_result
+    attempt["runtime"] = timedelta(seconds=int(time.time() - start_time))
+    attempt["start_at_task"] = start_at_task
+
+    if args.resume:
+        update_resume_state(
+            args.resume_state_file,
+            attempt,
+            git_result["after"],
+            args.playbook_path,
+            args.tags,
+            resume_state if start_at_task else None,
+        )
 
-def enqueue_output(out, queue):
-    logger.debug("enqueue_output: type(out): %s", type(out))
+    return attempt
+
+
+def run_ansible(
+    ansible_cmd, timeout, failure_matcher, cwd=None, tag_group=None, processes=None
+):
+    """Runs Ansible, logging its output as it arrives, and returns the attempt
+
+    A failed Git checkout or download is recognized as soon as the Git module
+    result is output, and the process is terminated right away so that the
+    recovery can start without waiting for Ansible to finish.
+
+    The output of a tag group, running concurrently with others, is logged
+    prefixed with its tags, and its process is added to `processes`.
+    """
+    ansible_process = None
+    logger_process = None
+    start_time = time.time()
+    rule_matches = RuleMatches(failure_matcher)
+    git_watcher = GitResultWatcher()
+    git_failure_type = None
+    ansible_output_lines = []
+    last_task = None
+    timed_out = False
+    output_ended = False
+
+    if tag_group is None:
+        log_extra, log_prefix = ansible_log_extra, ""
+    else:
+        log_extra = dict(ansible_log_extra, tag_group=tag_group, task=None)
+        log_prefix = "[%s] " % tag_group
 
     try:
-        first_time = True
+        set_log_context(phase="ansible")
+        logger.info("Running Ansible command: %s", " ".join(ansible_cmd))
+        queue = Queue()
+        with process_start_lock:
+            ansible_process = subprocess_popen_pipe_output(ansible_cmd, cwd=cwd)
+            logger_process = Process(
+                target=enqueue_output,
+                args=(ansible_process.stdout, queue),
+                daemon=True,
+            )
+            logger_process.start()
+
+        logger.info("Started Ansible process with PID: %s", ansible_process.pid)
+        if processes is not None:
+            processes.add(ansible_process)
 
-        for line in iter(out.readline, ""):
-            clean_line = line.rstrip()
-            if first_time:
-                logger.debug(
-                    "Logging Thread[%s] First time queueing output...", os.getpid()
+        loop_ender = LoopEnder(ansible_process, start_time, timeout)
+
+        while loop_ender.keep_going(output_ended):
+            batches = []
+            try:
+                batches.append(queue.get(timeout=0.1))
+                while True:
+                    batches.append(queue.get(block=False))
+            except Empty:
+                pass
+
+            if None in batches:
+                output_ended = True
+
+            for line in decode_lines(batches):
+                task = get_task_name(line)
+                if task is not None:
+                    last_task = task
+                    if tag_group is None:
+                        log_context["task"] = task
+                    else:
+                        log_extra["task"] = task
+
+                logger.info(log_prefix + line, extra=log_extra)
+                rule_matches.feed(line)
+                ansible_output_lines.append(line)
+
+                git_result = git_watcher.feed(line)
+                if git_result:
+                    git_failure_type = get_git_failure_type({"git_result": git_result})
+
+            # The rest of the batch is still logged and matched before stopping
+            if git_failure_type:
+                logger.warning(
+                    "Git failed to %s, terminating Ansible Pull early. PID[%s]",
+                    git_failure_type,
+                    ansible_process.pid,
                 )
-                first_time = False
-
-            logger.debug(
-                "Logging Thread[%s] queueing (size=%s) output: [%s] '%s'",
-                os.getpid(),
-                queue.qsize(),
-                type(clean_line),
-                bytes(clean_line, "utf8"),
+                kill_softly(ansible_process)
+                break
+
+        if ansible_process.poll() is None:
+            timed_out = True
+
+    except ShutdownException:
+        logger.error("Ansible Pull result: Interrupted. PID[%s]", ansible_process.pid)
+        kill_softly(ansible_process)
+        raise
+    else:
+        if timed_out:
+            logger.error(
+                "Ansible Pull result: Timeout (%s seconds). PID[%s]",
+                timeout,
+                ansible_process.pid,
+            )
+            kill_softly(ansible_process)
+        else:
+            logger.info(
+                "Ansible Pull result: %s. PID[%s]. Return code: %s",
+                "Success" if ansible_process.returncode == 0 else "Failed",
+                ansible_process.pid,
+                ansible_process.returncode,
             )
-            queue.put(clean_line)
+    finally:
+        if processes is not None and ansible_process is not None:
+            processes.discard(ansible_process)
+
+        if logger_process is not None:
+            # The reader exits by itself once the output has ended, otherwise
+            # child processes of Ansible are still holding its output open
+            logger_process.join(timeout=1 if output_ended else 0)
+            if logger_process.is_alive():
+                logger_process.terminate()
+                logger_process.join()
+
+        end = time.time()
+        runtime = timedelta(seconds=int(end - start_time))
+
+    ansible_result = get_ansible_result("\n".join(ansible_output_lines))
+    ansible_result["rule_matches"] = rule_matches.as_list()
+    if git_watcher.git_result:
+        ansible_result["git_result"] = git_watcher.git_result
+
+    return {
+        "return_code": ansible_process.poll(),
+        "timed_out": timed_out,
+        "git_failure_type": git_failure_type or get_git_failure_type(ansible_result),
+        "runtime": runtime,
+        "ansible_seconds": (loop_ender.exit_time or end) - start_time,
+        "ansible_result": ansible_result,
+        "last_task": last_task,
+    }
+
+
+def enqueue_output(out, queue, chunk_size=read_chunk_size):
+    """Reads the raw output in large chunks and queues it in batches of lines
+
+    Each chunk is split into lines on its boundaries, keeping any incomplete
+    last line for the next chunk, and queued as one batch of undecoded lines.
+    None is queued once the output has ended.
+    """
+    logger.debug("Logging Thread[%s] Reading output...", os.getpid())
+    fd = out.fileno()
+    incomplete_line = b""
+
+    try:
+        chunk = os.read(fd, chunk_size)
+        while chunk:
+            lines = chunk.split(b"\n")
+            lines[0] = incomplete_line + lines[0]
+            incomplete_line = lines.pop()
+
+            if lines:
+                queue.put(lines)
+
+            chunk = os.read(fd, chunk_size)
+
+        if incomplete_line:
+            queue.put([incomplete_line])
 
     except ShutdownException:
         logger.info("Received `ShutdownException`, ending enqueue_output() loop")
     finally:
+        queue.put(None)
         logger.debug("Logging Thread[%s] Ran out of output, quitting...", os.getpid())
+
+
+def decode_lines(batches):
+    """Decodes the lines of the batches, replacing bytes that aren't UTF-8"""
+    for batch in batches:
+        if batch is not None:
+            for line in batch:
+                yield line.decode("utf-8", errors="replace").rstrip()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,157 @@
+import logging
+import re
+import time
+
+from run_ansible_pull.logger import logger_label
+from run_ansible_pull.system import write_file_atomically
+
+metric_prefix = "run_ansible_pull_"
+
+# Name, type, help
+metric_definitions = [
+    ("last_run_timestamp_seconds", "gauge", "When the last run finished."),
+    ("last_run_duration_seconds", "gauge", "Duration of the last run."),
+    ("last_run_return_code", "gauge", "Return code of the last Ansible attempt."),
+    ("last_run_attempts", "gauge", "Number of Ansible attempts in the last run."),
+    ("last_run_tasks", "gauge", "Tasks of the last run by recap status."),
+    ("last_run_git_changed", "gauge", "Whether the last run pulled a new commit."),
+    (
+        "last_run_git_commit_age_seconds",
+        "gauge",
+        "Age of the commit checked out by the last run.",
+    ),
+    (
+        "last_run_wrapper_overhead_seconds",
+        "gauge",
+        "Time of the last run not spent in Ansible or waiting to retry.",
+    ),
+    ("last_success_timestamp_seconds", "gauge", "When the last successful run ended."),
+    ("runs_total", "counter", "Runs completed."),
+    ("timeouts_total", "counter", "Ansible attempts that timed out."),
+    ("interrupts_total", "counter", "Runs interrupted by a signal."),
+]
+
+# Carried over from the previous textfile, since it is rewritten every run
+persistent_metrics = [
+    "last_success_timestamp_seconds",
+    "runs_total",
+    "timeouts_total",
+    "interrupts_total",
+]
+
+pattern_sample = re.compile(
+    r"^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>{[^}]*})?\s+(?P<value>\S+)\s*$"
+)
+
+logger = logging.getLogger(logger_label)
+
+
+def read_textfile_metrics(path):
+    """Returns the samples of a textfile as {(name, labels): value}"""
+    samples = dict()
+
+    try:
+        with open(path) as f:
+            for line in f:
+                m = re.match(pattern_sample, line)
+                if m and m.group("name").startswith(metric_prefix):
+                    name = m.group("name")[len(metric_prefix) :]
+                    try:
+                        samples[(name, m.group("labels") or "")] = float(
+                            m.group("value")
+                        )
+                    except ValueError:
+                        pass
+    except OSError:
+        pass
+
+    return samples
+
+
+def format_textfile_metrics(samples):
+    lines = []
+
+    for name, metric_type, metric_help in metric_definitions:
+        metric_samples = sorted(
+            (labels, value) for (n, labels), value in samples.items() if n == name
+        )
+        if not metric_samples:
+            continue
+
+        lines.append("# HELP %s%s %s" % (metric_prefix, name, metric_help))
+        lines.append("# TYPE %s%s %s" % (metric_prefix, name, metric_type))
+        for labels, value in metric_samples:
+            lines.append("%s%s%s %s" % (metric_prefix, name, labels, repr(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile_metrics(path, samples):
+    """Writes the textfile atomically, so node-exporter never reads half of it
+
+    Failing to write the metrics is only logged, so that it never aborts a run.
+    """
+    try:
+        write_file_atomically(path, format_textfile_metrics(samples), mode=0o644)
+    except OSError as e:
+        logger.warning("Writing metrics textfile failed: '%s': %s", path, e)
+
+
+def get_run_samples(attempts, duration, overhead, git_commit_time, now):
+    attempt = attempts[-1]
+    ansible_result = attempt["ansible_result"]
+    samples = {
+        ("last_run_timestamp_seconds", ""): now,
+        ("last_run_duration_seconds", ""): duration,
+        ("last_run_attempts", ""): len(attempts),
+        ("last_run_wrapper_overhead_seconds", ""): max(0.0, overhead),
+    }
+
+    if attempt["return_code"] is not None:
+        samples[("last_run_return_code", "")] = attempt["return_code"]
+
+    play_recap = ansible_result.get("play_recap")
+    if play_recap:
+        for status in ["ok", "changed", "unreachable", "failed"]:
+            labels = '{status="%s"}' % status
+            samples[("last_run_tasks", labels)] = play_recap["%s_count" % status]
+
+    git_result = ansible_result.get("git_result")
+    if git_result:
+        samples[("last_run_git_changed", "")] = int(bool(git_result["changed"]))
+
+    if git_commit_time is not None:
+        samples[("last_run_git_commit_age_seconds", "")] = now - git_commit_time
+
+    return samples
+
+
+def record_run_metrics(
+    path, attempts, duration, overhead, git_commit_time=None, now=None
+):
+    """Writes the metrics of a finished run, updating the persistent ones"""
+    now = time.time() if now is None else now
+    previous = read_textfile_metrics(path)
+
+    samples = {key: previous[key] for key in previous if key[0] in persistent_metrics}
+    samples.update(get_run_samples(attempts, duration, overhead, git_commit_time, now))
+
+    for counter in ["runs_total", "timeouts_total", "interrupts_total"]:
+        samples.setdefault((counter, ""), 0.0)
+
+    samples[("runs_total", "")] += 1
+    samples[("timeouts_total", "")] += sum(1 for a in attempts if a["timed_out"])
+    if attempts[-1]["return_code"] == 0:
+        samples[("last_success_timestamp_seconds", "")] = now
+
+    logger.debug("Writing metrics to textfile: '%s'", path)
+    write_textfile_metrics(path, samples)
+
+
+def record_interrupt_metrics(path):
+    """Counts an interrupted run, keeping the metrics of the last finished run"""
+    samples = read_textfile_metrics(path)
+    samples[("interrupts_total", "")] = samples.get(("interrupts_total", ""), 0) + 1
+
+    logger.debug("Writing metrics to textfile: '%s'", path)
+    write_textfile_metrics(path, samples)
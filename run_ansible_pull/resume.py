@@ -0,0 +1,104 @@
+import logging
+import os
+
+from run_ansible_pull.logger import logger_label
+from run_ansible_pull.system import read_json_state, write_json_state
+
+path_resume_state_file = "/var/lib/run-ansible-pull/resume-state.json"
+resume_max = 3
+resume_state_keys = ["commit", "playbook_path", "tags", "task", "resume_count"]
+
+logger = logging.getLogger(logger_label)
+
+
+def read_resume_state(path):
+    """Returns where the last failed run stopped, or None if it's unknown"""
+    return read_json_state(path, resume_state_keys, "resume")
+
+
+def clear_resume_state(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Removing resume state file failed: '%s': %s", path, e)
+
+
+def get_resume_task(state, commit, playbook_path, tags, max_resumes):
+    """Returns the task to start at, or None to run the whole playbook
+
+    A run only resumes the same playbook and tags at the same commit, since
+    a new commit may have changed the tasks before the failed one, and only
+    up to `max_resumes` times in a row, so that a task that keeps failing
+    gets a full run every so often.
+    """
+    if state is None or commit is None:
+        return None
+
+    if (state["commit"], state["playbook_path"], state["tags"]) != (
+        commit,
+        playbook_path,
+        tags,
+    ):
+        logger.info(
+            "Not resuming at task: [%s], the commit or playbook changed.",
+            state["task"],
+        )
+        return None
+
+    if state["resume_count"] >= max_resumes:
+        logger.info(
+            "Not resuming at task: [%s], already resumed %s times.",
+            state["task"],
+            state["resume_count"],
+        )
+        return None
+
+    return state["task"]
+
+
+def get_failed_task(attempt):
+    """Returns the task an attempt failed or timed out in, or None"""
+    ansible_result = attempt["ansible_result"]
+    play_failure = ansible_result.get("play_failure")
+    play_recap = ansible_result.get("play_recap")
+
+    if play_failure and play_recap and play_recap["failed_count"] > 0:
+        return play_failure["role_and_task_names"]
+
+    if attempt["timed_out"]:
+        return attempt.get("last_task")
+
+    return None
+
+
+def update_resume_state(path, attempt, commit, playbook_path, tags, resumed_state):
+    """Records where a failed attempt stopped, or forgets it after a success
+
+    `resumed_state` is the state the attempt resumed from, if it did, so that
+    resumes in a row are counted.
+    """
+    if attempt["return_code"] == 0 and not attempt["timed_out"]:
+        clear_resume_state(path)
+        return
+
+    task = get_failed_task(attempt)
+    if task is None or commit is None:
+        # Nothing to resume at, start over next time
+        clear_resume_state(path)
+        return
+
+    resume_count = resumed_state["resume_count"] + 1 if resumed_state else 0
+    logger.info("Recording task to resume at: [%s]", task)
+    write_json_state(
+        path,
+        {
+            "commit": commit,
+            "playbook_path": playbook_path,
+            "tags": tags,
+            "task": task,
+            "resume_count": resume_count,
+        },
+        "resume",
+    )
@@ -0,0 +1,137 @@
+import logging
+import random
+
+from run_ansible_pull.logger import logger_label
+from run_ansible_pull.rules import ACTION_RETRY, ACTION_DELETE_WORK_DIR
+
+FAILURE_GIT_DOWNLOAD = "git_download"
+FAILURE_GIT_CHECKOUT = "git_checkout"
+FAILURE_TIMEOUT = "timeout"
+FAILURE_LOCK_CONTENTION = "lock_contention"
+FAILURE_TRANSIENT = "transient"
+FAILURE_UNREACHABLE = "unreachable"
+FAILURE_FAILED = "failed"
+
+failure_classes = (
+    FAILURE_GIT_DOWNLOAD,
+    FAILURE_GIT_CHECKOUT,
+    FAILURE_TIMEOUT,
+    FAILURE_LOCK_CONTENTION,
+    FAILURE_TRANSIENT,
+    FAILURE_UNREACHABLE,
+    FAILURE_FAILED,
+)
+
+default_retry_on = (
+    FAILURE_GIT_DOWNLOAD,
+    FAILURE_GIT_CHECKOUT,
+    FAILURE_LOCK_CONTENTION,
+    FAILURE_TRANSIENT,
+    FAILURE_UNREACHABLE,
+)
+
+logger = logging.getLogger(logger_label)
+
+
+def classify_failure(attempt):
+    """Returns the failure class of an attempt, or None if it succeeded"""
+    git_failure_type = attempt["git_failure_type"]
+    if git_failure_type == "download":
+        return FAILURE_GIT_DOWNLOAD
+    if git_failure_type == "checkout":
+        return FAILURE_GIT_CHECKOUT
+
+    if attempt["timed_out"]:
+        return FAILURE_TIMEOUT
+
+    if attempt["return_code"] == 0:
+        return None
+
+    for rule_match in attempt["ansible_result"].get("rule_matches", []):
+        if rule_match["failure_class"]:
+            return rule_match["failure_class"]
+        if rule_match["action"] in (ACTION_RETRY, ACTION_DELETE_WORK_DIR):
+            return FAILURE_TRANSIENT
+
+    play_recap = attempt["ansible_result"].get("play_recap")
+    if play_recap and play_recap["unreachable_count"] > 0:
+        return FAILURE_UNREACHABLE
+
+    return FAILURE_FAILED
+
+
+class RetryPolicy:
+    """Decides whether, and after how long, a failed attempt is run again
+
+    Attempts are retried with exponential backoff and jitter, as long as the
+    failure class is retryable, the maximum number of attempts hasn't been
+    reached, and the next attempt would start within the total time budget.
+    """
+
+    def __init__(
+        self,
+        max_attempts=2,
+        backoff=2.0,
+        backoff_max=60.0,
+        jitter=0.5,
+        time_budget=None,
+        retry_on=default_retry_on,
+        _random=random.random,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.time_budget = time_budget
+        self.retry_on = set(retry_on)
+        self._random = _random
+
+    def backoff_delay(self, attempt_number):
+        """Returns the seconds to wait after the given attempt, starting at 1"""
+        delay = min(self.backoff * 2 ** (attempt_number - 1), self.backoff_max)
+        return delay - delay * self.jitter * self._random()
+
+    def next_delay(self, failure_class, attempt_number, elapsed):
+        """Returns the seconds to wait before retrying, or None to stop"""
+        if failure_class is None:
+            return None
+
+        if failure_class not in self.retry_on:
+            logger.info("Not retrying failure: %s", failure_class)
+            return None
+
+        if attempt_number >= self.max_attempts:
+            logger.warning(
+                "Not retrying failure: %s, reached maximum attempts: %s",
+                failure_class,
+                self.max_attempts,
+            )
+            return None
+
+        delay = self.backoff_delay(attempt_number)
+
+        if self.time_budget is not None and elapsed + delay >= self.time_budget:
+            logger.warning(
+                "Not retrying failure: %s, time budget of %s seconds exhausted",
+                failure_class,
+                self.time_budget,
+            )
+            return None
+
+        return delay
+
+
+def format_attempts_summary(attempts):
+    """Formats one summary line per attempt, for runs that were retried"""
+    if len(attempts) < 2:
+        return ""
+
+    return "\n".join(
+        "Attempt %s: [%s] %s"
+        % (
+            number,
+            attempt["failure_class"] or "success",
+            attempt["summary"].replace("\n", "; "),
+        )
+        for number, attempt in enumerate(attempts, start=1)
+    )
@@ -0,0 +1,301 @@
+import logging
+import os
+import re
+
+import yaml
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    # Python before 3.11
+    import sre_constants
+    import sre_parse
+
+from run_ansible_pull.logger import logger_label
+from run_ansible_pull.sensu import (
+    SENSU_OK,
+    SENSU_WARNING,
+    SENSU_CRITICAL,
+    SENSU_UNKNOWN,
+)
+
+ACTION_SENSU = "sensu"
+ACTION_RETRY = "retry"
+ACTION_DELETE_WORK_DIR = "delete_work_dir"
+ACTION_IGNORE = "ignore"
+
+rule_actions = (ACTION_SENSU, ACTION_RETRY, ACTION_DELETE_WORK_DIR, ACTION_IGNORE)
+
+rule_severities = {
+    "ok": SENSU_OK,
+    "warning": SENSU_WARNING,
+    "critical": SENSU_CRITICAL,
+    "unknown": SENSU_UNKNOWN,
+}
+
+path_default_failure_rules = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "failure_rules.yaml"
+)
+
+# Inline flags at the start of a pattern, which apply to the whole pattern
+pattern_global_flags = re.compile(r"^\(\?(?P<flags>[aiLmsux]+)\)")
+
+# References to groups by number, which change meaning once the pattern is
+# wrapped in a group: backreferences, outside of character classes, and
+# conditionals. Only matched after an even number of backslashes.
+pattern_group_reference = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\()")
+
+# Inline flags turning on case-insensitive matching, anywhere in a pattern
+pattern_ignore_case_flag = re.compile(r"\(\?[aiLmsux]*i[aiLmsux]*(?:-[imsx]+)?[:)]")
+
+pattern_repeat_ops = tuple(
+    getattr(sre_constants, x)
+    for x in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(sre_constants, x)
+)
+
+logger = logging.getLogger(logger_label)
+
+
+class FailureRule:
+    def __init__(
+        self, name, pattern, severity, action, ignore_case=False, failure_class=None
+    ):
+        self.name = name
+        self.pattern = pattern
+        self.severity = severity
+        self.action = action
+        self.ignore_case = ignore_case
+        self.failure_class = failure_class
+
+    def __repr__(self):
+        return "FailureRule(%r, %r, severity=%r, action=%r)" % (
+            self.name,
+            self.pattern,
+            self.severity,
+            self.action,
+        )
+
+
+def get_scoped_pattern(pattern, ignore_case=False):
+    """Returns the pattern with its inline flags scoped to the pattern itself
+
+    Inline flags like `(?i)` must be at the start of the whole regular
+    expression, so they are turned into a `(?i:...)` group when the pattern
+    is combined with others.
+    """
+    flags = "i" if ignore_case else ""
+
+    m = re.match(pattern_global_flags, pattern)
+    while m:
+        flags += m.group("flags")
+        pattern = pattern[m.end() :]
+        m = re.match(pattern_global_flags, pattern)
+
+    return "(?%s:%s)" % (flags, pattern) if flags else pattern
+
+
+def get_required_literals(items):
+    """Returns literals one of which every match of the parsed pattern contains
+
+    Only ASCII characters are taken, lowercased, and the set whose shortest
+    literal is the longest wins. Returns None if no literal is required.
+    """
+    best = None
+    run = []
+
+    def consider(literals):
+        nonlocal best
+        if literals and (best is None or min(map(len, literals)) > min(map(len, best))):
+            best = literals
+
+    for op, av in items:
+        if op is sre_constants.LITERAL and av < 128:
+            run.append(chr(av).lower())
+            continue
+
+        consider(["".join(run)] if run else None)
+        run = []
+
+        if op is sre_constants.SUBPATTERN:
+            consider(get_required_literals(av[-1]))
+        elif op is getattr(sre_constants, "ATOMIC_GROUP", None):
+            consider(get_required_literals(av))
+        elif op is sre_constants.BRANCH:
+            branches = [get_required_literals(x) for x in av[1]]
+            if all(branches):
+                consider([x for branch in branches for x in branch])
+        elif op in pattern_repeat_ops and av[0] >= 1:
+            consider(get_required_literals(av[2]))
+
+    consider(["".join(run)] if run else None)
+    return best
+
+
+class FailureMatcher:
+    """Matches output lines against the failure rules, first rule in file order
+
+    The first rule in file order matching anywhere in the line wins, so an
+    `ignore` rule placed before a broader rule suppresses it for the lines it
+    matches.
+
+    Searching every pattern in every line gets slow with many rules, so each
+    rule has the literals one of which any line it matches contains, like
+    `Could not resolve host`. A line is lowercased once and only the patterns
+    of the rules whose literals it contains are searched, which for the lines
+    that match no rule, nearly all of them, leaves one substring test per
+    literal. A rule without a literal of at least `min_literal_length`
+    characters is searched in every line.
+    """
+
+    min_literal_length = 3
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._patterns = []
+        self._literals = []
+        self._always_searched = []
+        self._ignore_case = []
+
+        for index, rule in enumerate(self.rules):
+            pattern = get_scoped_pattern(rule.pattern, rule.ignore_case)
+            self._patterns.append(re.compile(pattern))
+            self._ignore_case.append(bool(re.search(pattern_ignore_case_flag, pattern)))
+
+            literals = get_required_literals(sre_parse.parse(pattern))
+            if literals and min(map(len, literals)) >= self.min_literal_length:
+                self._literals.extend((x, index) for x in set(literals))
+            else:
+                self._always_searched.append(index)
+
+    def match(self, line):
+        """Returns the first rule in file order matching the line, or None"""
+        lowered = line.lower()
+        candidates = set(self._always_searched)
+        candidates.update(
+            index for literal, index in self._literals if literal in lowered
+        )
+
+        # Case-insensitive patterns match non-ASCII characters folding to ASCII
+        if not line.isascii():
+            candidates.update(i for i, x in enumerate(self._ignore_case) if x)
+
+        for index in sorted(candidates):
+            if self._patterns[index].search(line):
+                return self.rules[index]
+
+        return None
+
+
+class RuleMatches:
+    """Collects the first matching line of each rule seen during a run"""
+
+    def __init__(self, matcher):
+        self._matcher = matcher
+        self._matches = dict()
+
+    def feed(self, line):
+        rule = self._matcher.match(line)
+        if rule is not None and rule.name not in self._matches:
+            logger.debug("Failure rule '%s' matched line: %s", rule.name, line)
+            self._matches[rule.name] = (rule, line.strip())
+        return rule
+
+    def as_list(self):
+        """Returns the matches, without ignored ones, as summary dicts"""
+        return [
+            {
+                "name": rule.name,
+                "severity": rule.severity,
+                "action": rule.action,
+                "failure_class": rule.failure_class,
+                "line": line,
+            }
+            for rule, line in self._matches.values()
+            if rule.action != ACTION_IGNORE
+        ]
+
+
+def worst_rule_severity(rule_matches, default=SENSU_OK):
+    """Returns the worst severity of the matches, or the default if there are none"""
+    if not rule_matches:
+        return default
+
+    return max(m["severity"] for m in rule_matches)
+
+
+def rule_actions_matched(rule_matches):
+    return set(m["action"] for m in rule_matches)
+
+
+def parse_failure_rules(rules_data):
+    rules = []
+
+    for item in rules_data or []:
+        name = item.get("name")
+        if not name:
+            raise ValueError("Failure rule without a name: %s" % item)
+
+        pattern = item.get("pattern")
+        if not pattern:
+            raise ValueError("Failure rule '%s' has no pattern" % name)
+
+        try:
+            compiled = re.compile(pattern)
+        except re.error as e:
+            raise ValueError("Failure rule '%s' has an invalid pattern: %s" % (name, e))
+
+        if compiled.groupindex:
+            raise ValueError(
+                "Failure rule '%s' must not use named groups: %s" % (name, pattern)
+            )
+
+        if re.search(pattern_group_reference, pattern):
+            raise ValueError(
+                "Failure rule '%s' must not refer to groups by number: %s"
+                % (name, pattern)
+            )
+
+        severity = str(item.get("severity", "critical")).lower()
+        if severity not in rule_severities:
+            raise ValueError(
+                "Failure rule '%s' has an unknown severity: '%s', expected one of: %s"
+                % (name, severity, ", ".join(rule_severities))
+            )
+
+        action = str(item.get("action", ACTION_SENSU)).lower()
+        if action not in rule_actions:
+            raise ValueError(
+                "Failure rule '%s' has an unknown action: '%s', expected one of: %s"
+                % (name, action, ", ".join(rule_actions))
+            )
+
+        rules.append(
+            FailureRule(
+                name,
+                pattern,
+                rule_severities[severity],
+                action,
+                ignore_case=bool(item.get("ignore_case", False)),
+                failure_class=item.get("class"),
+            )
+        )
+
+    # The patterns are valid on their own, make sure they still are with the
+    # flags of the rules scoped to them
+    try:
+        FailureMatcher(rules)
+    except re.error as e:
+        raise ValueError("Failure rules can't be compiled with their flags: %s" % e)
+
+    return rules
+
+
+def load_failure_rules(path):
+    with open(path) as f:
+        rules_data = yaml.safe_load(f) or dict()
+
+    rules = parse_failure_rules(rules_data.get("failure_rules"))
+    logger.info("Loaded %s failure rules from file: '%s'", len(rules), path)
+
+    return FailureMatcher(rules)
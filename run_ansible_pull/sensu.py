@@ -1,11 +1,18 @@
+import hashlib
 import json
 import logging
+import re
+import time
 from socket import socket
 
 from run_ansible_pull.logger import logger_label
+from run_ansible_pull.system import read_json_state, write_json_state
 
 sensu_host = "localhost"
 sensu_port = 3030
+sensu_heartbeat = 3600
+path_sensu_state_file = "/var/lib/run-ansible-pull/sensu-state.json"
+sensu_state_keys = ["status", "digest", "time"]
 
 SENSU_OK = 0
 SENSU_WARNING = 1
@@ -13,6 +20,9 @@ SENSU_CRITICAL = 2
 SENSU_UNKNOWN = 3
 SENSU_CUSTOM = 4
 
+# Parts of the summary that change every run without anything having changed
+pattern_volatile_summary = re.compile(r"(?<=Runtime: )[^;\n]*")
+
 logger = logging.getLogger(logger_label)
 
 
@@ -56,9 +66,16 @@ def format_sensu_summary(ansible_result, runtime):
             )
         )
 
+    known_failures = None
+    if ansible_result.get("rule_matches"):
+        known_failures = ", ".join(
+            '[%s] "%s"' % (x["name"], x["line"]) for x in ansible_result["rule_matches"]
+        )
+
     summary_lines = [
         ("Git failed!: %s" % git_failure if git_failure else ""),
         ("Play failed!: %s" % play_failure if play_failure else ""),
+        ("Known failures: %s" % known_failures if known_failures else ""),
         ("Play Recap: %s" % play_recap if play_recap else ""),
         ("Runtime: %s" % runtime if runtime is not None else ""),
     ]
@@ -66,7 +83,7 @@ def format_sensu_summary(ansible_result, runtime):
     return "\n".join([line for line in summary_lines if line])
 
 
-def send_sensu_event(status, summary, enabled=True):
+def send_sensu_event(status, summary, enabled=True, host=sensu_host, port=sensu_port):
     """Send the event to the Sensu server through a socket"""
 
     event = {
@@ -82,22 +99,22 @@ def send_sensu_event(status, summary, enabled=True):
         sock = socket()
         try:
             data = json.dumps(event) + "\n"
-            sock.connect((sensu_host, sensu_port))
+            sock.connect((host, port))
             sock.sendall(data.encode())
         except ConnectionRefusedError:
             logger.error(
                 "Sending Sensu event failed: "
                 + "Connection refused while connecting to socket %s:%s",
-                sensu_host,
-                sensu_port,
+                host,
+                port,
             )
             success = False
         except Exception as e:
             logger.error(
                 "Sending Sensu event failed: " + "Exception: %s, Socket: %s:%s",
                 e,
-                sensu_host,
-                sensu_port,
+                host,
+                port,
             )
         else:
             success = True
@@ -108,3 +125,75 @@ def send_sensu_event(status, summary, enabled=True):
         success = True
 
     return success
+
+
+def get_summary_digest(summary):
+    """Returns a hash of the summary that ignores the runtimes in it"""
+    normalized = re.sub(pattern_volatile_summary, "", summary)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def get_sensu_send_reason(state, status, digest, heartbeat, now):
+    """Returns why the event should be sent, or None to suppress it
+
+    Events are sent when the status or the summary changes, and at least every
+    `heartbeat` seconds otherwise, so that TTL checks stay alive. A heartbeat
+    of 0 sends every event.
+    """
+    if not heartbeat:
+        return "heartbeat disabled"
+    if state is None:
+        return "no previous event"
+    if state["status"] != status:
+        return "status changed from %s" % state["status"]
+    if state["digest"] != digest:
+        return "summary changed"
+    if not 0 <= now - state["time"] < heartbeat:
+        return "heartbeat"
+
+    return None
+
+
+def send_sensu_event_on_change(
+    status,
+    summary,
+    state_path,
+    heartbeat=sensu_heartbeat,
+    enabled=True,
+    host=sensu_host,
+    port=sensu_port,
+    now=None,
+):
+    """Send the event unless it repeats the last one sent within the heartbeat
+
+    The state is only updated once an event has been sent, so that a failed
+    event is sent again by the next run.
+    """
+    if not enabled or state_path is None:
+        return send_sensu_event(status, summary, enabled, host, port)
+
+    now = time.time() if now is None else now
+    digest = get_summary_digest(summary)
+    reason = get_sensu_send_reason(
+        read_json_state(state_path, sensu_state_keys, "Sensu"),
+        status,
+        digest,
+        heartbeat,
+        now,
+    )
+
+    if reason is None:
+        logger.info(
+            "Suppressing Sensu event with status %s, unchanged since the last one",
+            status,
+        )
+        return True
+
+    logger.info("Sending Sensu event with status %s: %s", status, reason)
+    success = send_sensu_event(status, summary, enabled, host, port)
+    if success:
+        write_json_state(
+            state_path, {"status": status, "digest": digest, "time": now}, "Sensu"
+        )
+
+    return success
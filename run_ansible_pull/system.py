@@ -1,11 +1,12 @@
 import atexit
 import fcntl
+import json
 import logging
 import os
 import shutil
 import signal
 import subprocess
-import sys
+import tempfile
 import time
 
 import psutil
@@ -13,85 +14,209 @@ from psutil import NoSuchProcess, ZombieProcess
 
 from run_ansible_pull.logger import logger_label
 
+path_lock_file = "/tmp/run-ansible-pull.lock"
+
 logger = logging.getLogger(logger_label)
 
 
-def instance_already_running():
-    lockfile = os.open("/tmp/run-ansible-pull.lock", os.O_CREAT | os.O_WRONLY)
+_lock_files = dict()
+
+
+def instance_already_running(lock_path=path_lock_file):
+    lockfile = os.open(lock_path, os.O_CREAT | os.O_WRONLY)
 
     try:
         fcntl.lockf(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
         already_running = False
     except IOError:
+        os.close(lockfile)
         already_running = True
+    else:
+        _lock_files[lock_path] = lockfile
 
     return already_running
 
 
-def subprocess_popen_pipe_output(cmd):
-    kwargs_line_buffered = dict(bufsize=1)
-    if sys.hexversion >= 0x3070000:
-        # "text" was added as a keyword argument alias for "universal_newlines"
-        # in Python 3.7, and "universal_newlines" is provided still only for
-        # backwards compatibility. Let's do this right if we're going to do it.
-        kwargs_line_buffered = {**dict(text=True), **kwargs_line_buffered}
-    else:
-        # For systems with python before 3.7, use "universal_newlines"
-        kwargs_line_buffered = {**dict(universal_newlines=True), **kwargs_line_buffered}
-
+def release_instance_lock(lock_path=path_lock_file):
+    lockfile = _lock_files.pop(lock_path, None)
+    if lockfile is not None:
+        os.close(lockfile)
+
+
+class PendingRuns:
+    """Coalesces run requests that arrive while an instance is running
+
+    Contending instances append a request to the pending file, and the running
+    instance runs once more after it finishes if there were any, however many
+    there were. Both sides hold a lock on the pending file while checking the
+    instance lock, so that a request can't arrive between the running instance
+    finding no requests and releasing its lock.
+    """
+
+    def __init__(self, lock_path=path_lock_file):
+        self.lock_path = lock_path
+        self.pending_path = "%s.pending" % lock_path
+
+    def _open_locked(self):
+        pending_file = os.open(self.pending_path, os.O_CREAT | os.O_RDWR)
+        fcntl.lockf(pending_file, fcntl.LOCK_EX)
+        return pending_file
+
+    def request(self):
+        """Requests a follow-up run from the running instance
+
+        Returns False if no instance is running anymore, in which case the
+        instance lock has been acquired and this instance should run instead.
+        """
+        pending_file = self._open_locked()
+        try:
+            if not instance_already_running(self.lock_path):
+                return False
+
+            os.lseek(pending_file, 0, os.SEEK_END)
+            os.write(pending_file, b"%d %f\n" % (os.getpid(), time.time()))
+            return True
+        finally:
+            os.close(pending_file)
+
+    def clear(self):
+        """Drops requests made before this run started, since it serves them"""
+        pending_file = self._open_locked()
+        try:
+            os.ftruncate(pending_file, 0)
+        finally:
+            os.close(pending_file)
+
+    def consume(self):
+        """Returns whether to run again, releasing the instance lock if not"""
+        pending_file = self._open_locked()
+        try:
+            requests = os.fstat(pending_file).st_size > 0
+            if requests:
+                os.ftruncate(pending_file, 0)
+            else:
+                release_instance_lock(self.lock_path)
+            return requests
+        finally:
+            os.close(pending_file)
+
+
+def subprocess_popen_pipe_output(cmd, cwd=None):
+    # The output is read unbuffered, as raw bytes, by `main.enqueue_output()`
     return subprocess.Popen(
-        cmd, **kwargs_line_buffered, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        cmd,
+        bufsize=0,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
     )
 
 
-def kill_softly(parent_popen):
+def kill_softly(parent_popen, timeout=10):
+    """Terminates the process and its children, killing any that don't stop
+
+    The parent is terminated first, so that it gets a chance to stop its own
+    children, then any remaining children are terminated. Processes are waited
+    on until they exit instead of sleeping for a fixed amount of time.
+    """
     logger.info(
         "Terminating parent PID[%s] and all of its children...", parent_popen.pid
     )
 
     try:
         parent_process = psutil.Process(parent_popen.pid)
+        children = parent_process.children(recursive=True)
     except (NoSuchProcess, ZombieProcess):
         logger.warning(
             "Process PID[%s] does not exist or is a zombie.", parent_popen.pid
         )
-    else:
-        terminate_processes = [parent_process] + parent_process.children(recursive=True)
+        parent_popen.poll()
+        return
+
+    logger.info(
+        "Terminating all processes PID%s",
+        [p.pid for p in [parent_process] + children],
+    )
+
+    logger.info("Terminating process PID[%s]", parent_process.pid)
+    parent_popen.terminate()
+    try:
+        parent_popen.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
         logger.info(
-            "Terminating all processes PID%s", [p.pid for p in terminate_processes]
+            "Sending SIGKILL to process PID[%s] after %s seconds...",
+            parent_process.pid,
+            timeout,
         )
+        parent_popen.kill()
+        parent_popen.wait()
+
+    for process in children:
+        logger.info("Terminating process PID[%s]", process.pid)
+        try:
+            process.terminate()
+        except NoSuchProcess:
+            logger.debug("Process already stopped PID[%s]", process.pid)
 
-        for process in terminate_processes:
-            logger.info("Terminating process PID[%s]", process.pid)
-            try:
-                process.terminate()
-            except NoSuchProcess:
-                logger.debug("Process already stopped PID[%s]", process.pid)
-
-            attempts = 0
-            for attempt in range(1, 10 + 1):
-                attempts += 1
-                if process.is_running():
-                    logger.debug(
-                        "Waited %s seconds for PID: %s to terminate...",
-                        attempts,
-                        process.pid,
-                    )
-                    time.sleep(1)
-
-            if process.is_running():
-                logger.info(
-                    "Sending SIGKILL to process PID[%s] after %s seconds...",
-                    process.pid,
-                    attempts,
-                )
-                try:
-                    process.kill()
-                except NoSuchProcess:
-                    logger.debug("Process already stopped PID[%s]", process.pid)
-
-            # Give child processes time to be terminated by their parent
-            time.sleep(5)
+    _gone, alive = psutil.wait_procs(children, timeout=timeout)
+
+    for process in alive:
+        logger.info(
+            "Sending SIGKILL to process PID[%s] after %s seconds...",
+            process.pid,
+            timeout,
+        )
+        try:
+            process.kill()
+        except NoSuchProcess:
+            logger.debug("Process already stopped PID[%s]", process.pid)
+
+
+def write_file_atomically(path, text, mode=None):
+    """Writes the file through a temporary file, so it's never read half-written"""
+    directory = os.path.dirname(os.path.abspath(path))
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".%s." % os.path.basename(path), dir=directory
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_json_state(path, required_keys, label):
+    """Returns the state saved in the JSON file, or None if it's unknown
+
+    A missing file is expected, an unreadable or incomplete one is logged.
+    `label` names the file in the log, like "Sensu" for the Sensu state file.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        if set(required_keys) <= set(state):
+            return state
+        logger.warning("Ignoring incomplete %s state file: '%s'", label, path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning("Ignoring unreadable %s state file: '%s': %s", label, path, e)
+
+    return None
+
+
+def write_json_state(path, state, label):
+    """Saves the state to the JSON file, logging a failure instead of raising"""
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        write_file_atomically(path, json.dumps(state))
+    except OSError as e:
+        logger.warning("Writing %s state file failed: '%s': %s", label, path, e)
 
 
 def clean_tmp_dir():
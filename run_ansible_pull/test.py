@@ -1,12 +1,68 @@
 import inspect
+import json
+import logging
 import os
+import queue
+import subprocess
+import tempfile
 import unittest
 import yaml
 
 from datetime import timedelta
 
-from run_ansible_pull.ansible import get_ansible_result
-from run_ansible_pull.sensu import format_sensu_summary
+from run_ansible_pull.ansible import (
+    GitResultWatcher,
+    get_ansible_result,
+    get_git_failure_type,
+    get_task_name,
+)
+from run_ansible_pull.git import checkout_git_repo
+from run_ansible_pull.groups import format_groups_summary, merge_group_attempts
+from run_ansible_pull.harness.fake_sensu import FakeSensuServer
+from run_ansible_pull.harness.runner import make_git_repo
+from run_ansible_pull.logger import (
+    JsonFormatter,
+    ansible_log_extra,
+    log_context,
+    set_log_context,
+)
+from run_ansible_pull.main import decode_lines, enqueue_output, get_sensu_status
+from run_ansible_pull.metrics import (
+    read_textfile_metrics,
+    record_interrupt_metrics,
+    record_run_metrics,
+)
+from run_ansible_pull.resume import (
+    get_resume_task,
+    read_resume_state,
+    update_resume_state,
+)
+from run_ansible_pull.retry import (
+    FAILURE_FAILED,
+    FAILURE_GIT_DOWNLOAD,
+    FAILURE_TIMEOUT,
+    RetryPolicy,
+    classify_failure,
+)
+from run_ansible_pull.rules import (
+    ACTION_IGNORE,
+    FailureMatcher,
+    FailureRule,
+    get_required_literals,
+    load_failure_rules,
+    parse_failure_rules,
+    path_default_failure_rules,
+    sre_parse,
+)
+from run_ansible_pull.sensu import (
+    SENSU_CRITICAL,
+    SENSU_OK,
+    SENSU_UNKNOWN,
+    SENSU_WARNING,
+    format_sensu_summary,
+    get_summary_digest,
+    send_sensu_event_on_change,
+)
 
 
 class RunAnsiblePullTestCase(unittest.TestCase):
@@ -20,17 +76,465 @@ class RunAnsiblePullTestCase(unittest.TestCase):
         with open(test_data_path) as f:
             self.test_data = yaml.safe_load(f)
 
+    def make_attempt(
+        self, index_or_log, return_code, timed_out=False, rule_severities=(), **extra
+    ):
+        """Returns an attempt like `run_ansible` does, for a test log or its index
+
+        Each of `rule_severities` adds a matched rule of that severity, and
+        `extra` overrides the other keys of the attempt.
+        """
+        if isinstance(index_or_log, str):
+            log = index_or_log
+        else:
+            log = self.test_data["ansible_pull_logs"][index_or_log]["log"]
+
+        ansible_result = get_ansible_result(log)
+        ansible_result["rule_matches"] = [
+            {
+                "name": "rule%d" % i,
+                "severity": severity,
+                "action": "sensu",
+                "failure_class": None,
+                "line": "",
+            }
+            for i, severity in enumerate(rule_severities)
+        ]
+
+        attempt = {
+            "return_code": return_code,
+            "timed_out": timed_out,
+            "git_failure_type": get_git_failure_type(ansible_result),
+            "runtime": timedelta(seconds=10),
+            "ansible_seconds": 10.0,
+            "ansible_result": ansible_result,
+            "last_task": None,
+        }
+        attempt.update(extra)
+        return attempt
+
     def test_sensu_summaries(self):
         """Ensure generated Sensu Ansible summaries are correct"""
 
         for item in self.test_data["ansible_pull_logs"]:
             ansible_summary = get_ansible_result(item["log"])
             sensu_summary = format_sensu_summary(
-                ansible_summary, timedelta(seconds=item["runtime"]),
+                ansible_summary,
+                timedelta(seconds=item["runtime"]),
             )
 
             self.assertEqual(sensu_summary, item["summary"].rstrip())
 
+    def test_git_failure_types(self):
+        """Ensure Git checkout and download failures are recognized"""
+
+        for item in self.test_data["ansible_pull_logs"]:
+            ansible_result = get_ansible_result(item["log"])
+            self.assertEqual(
+                get_git_failure_type(ansible_result), item.get("git_failure_type")
+            )
+
+    def test_git_result_watcher(self):
+        """Ensure the Git result is recognized line by line as it is output"""
+
+        for item in self.test_data["ansible_pull_logs"]:
+            git_result = get_ansible_result(item["log"]).get("git_result")
+
+            watcher = GitResultWatcher()
+            for line in item["log"].splitlines():
+                watcher.feed(line)
+
+            self.assertEqual(watcher.git_result, git_result)
+
+    def test_failure_rules(self):
+        """Ensure the built-in failure rules match known failure lines"""
+
+        matcher = load_failure_rules(path_default_failure_rules)
+
+        for item in self.test_data["failure_rule_lines"]:
+            rule = matcher.match(item["line"])
+            self.assertEqual(rule.name if rule else None, item["rule"], item["line"])
+
+    def test_failure_rules_order(self):
+        """Ensure earlier rules win, so `ignore` rules can shadow later ones"""
+
+        matcher = FailureMatcher(
+            [
+                FailureRule(
+                    "harmless", r"lock held by us", SENSU_WARNING, ACTION_IGNORE
+                ),
+                FailureRule("lock", r"lock held", SENSU_WARNING, "retry"),
+            ]
+        )
+
+        self.assertEqual(matcher.match("the lock held by us").name, "harmless")
+        self.assertEqual(matcher.match("a lock held by them").name, "lock")
+        self.assertIsNone(matcher.match("no match"))
+
+        # The earlier rule wins even when a later one matches further left
+        matcher = FailureMatcher(
+            [
+                FailureRule("harmless", r"held by us", SENSU_WARNING, ACTION_IGNORE),
+                FailureRule("lock", r"lock held", SENSU_WARNING, "retry"),
+            ]
+        )
+
+        self.assertEqual(matcher.match("lock held by us").name, "harmless")
+        self.assertEqual(matcher.match("lock held by them").name, "lock")
+
+    def test_failure_rules_literals(self):
+        """Ensure only the rules whose literals are in a line are searched"""
+
+        self.assertEqual(
+            sorted(get_required_literals(sre_parse.parse(r"Could not (?:get|set) it"))),
+            ["could not "],
+        )
+        self.assertEqual(
+            sorted(get_required_literals(sre_parse.parse(r"x*(?:foo|bars)+\d"))),
+            ["bars", "foo"],
+        )
+        self.assertIsNone(get_required_literals(sre_parse.parse(r"\w+(?:ab)?")))
+
+        matcher = FailureMatcher(
+            [
+                FailureRule("dpkg", r"(?i)DPKG (?:was|got) interrupted", 2, "sensu"),
+                FailureRule("short", r"(?:a|bc)\d+", 1, "sensu"),
+                FailureRule("host", r"unknown host", 1, "sensu", ignore_case=True),
+            ]
+        )
+
+        self.assertEqual(matcher.match("E: dpkg was interrupted").name, "dpkg")
+        self.assertEqual(matcher.match("bc12 Unknown HOST").name, "short")
+        self.assertEqual(matcher.match("UNKNOWN HOST").name, "host")
+        # The long s matches "s" case-insensitively
+        self.assertEqual(matcher.match("unknown ho\u017ft").name, "host")
+        self.assertIsNone(matcher.match("nothing known here"))
+
+    def test_failure_rules_validation(self):
+        """Ensure rule patterns are valid with their flags scoped to them"""
+
+        matcher = FailureMatcher(
+            parse_failure_rules(
+                [
+                    {"name": "foo", "pattern": "foo"},
+                    {"name": "bar", "pattern": "(?i)(?s)bar", "ignore_case": True},
+                    {"name": "path", "pattern": r"C:\\1 [0-9]"},
+                ]
+            )
+        )
+
+        self.assertEqual(matcher.match("a BAR").name, "bar")
+        self.assertEqual(matcher.match("in C:\\1 2").name, "path")
+
+        for pattern in [r"(x)\1", r"(x)?(?(1)y|z)", "(?P<name>x)", "(?i"]:
+            with self.assertRaises(ValueError, msg=pattern):
+                parse_failure_rules([{"name": "invalid", "pattern": pattern}])
+
+    def test_sensu_status(self):
+        """Ensure known failures set the status of failed attempts only"""
+
+        def status(return_code, severities, *args, timed_out=False):
+            attempt = self.make_attempt(
+                2, return_code, timed_out, rule_severities=severities
+            )
+            return get_sensu_status(attempt, *args)
+
+        self.assertEqual(status(0, [SENSU_UNKNOWN]), SENSU_OK)
+        self.assertEqual(status(0, [], True), SENSU_WARNING)
+        self.assertEqual(status(2, [SENSU_WARNING]), SENSU_WARNING)
+        self.assertEqual(status(2, [SENSU_WARNING, SENSU_UNKNOWN]), SENSU_UNKNOWN)
+        self.assertEqual(status(2, []), SENSU_CRITICAL)
+        self.assertEqual(status(2, [SENSU_OK], True), SENSU_WARNING)
+        self.assertEqual(status(None, [], timed_out=True), SENSU_CRITICAL)
+
+    def test_classify_failure(self):
+        """Ensure attempts are classified by their most specific failure"""
+
+        self.assertEqual(classify_failure(self.make_attempt(0, 2)), "git_checkout")
+        self.assertEqual(
+            classify_failure(self.make_attempt(7, 2)), FAILURE_GIT_DOWNLOAD
+        )
+        self.assertEqual(classify_failure(self.make_attempt(1, 2)), FAILURE_FAILED)
+        self.assertEqual(
+            classify_failure(self.make_attempt(1, None, True)), FAILURE_TIMEOUT
+        )
+        self.assertIsNone(classify_failure(self.make_attempt(2, 0)))
+
+    def test_retry_policy(self):
+        """Ensure retries back off, and stop at the attempt and time limits"""
+
+        policy = RetryPolicy(
+            max_attempts=4,
+            backoff=2,
+            backoff_max=5,
+            jitter=0.5,
+            time_budget=60,
+            retry_on=[FAILURE_GIT_DOWNLOAD],
+            _random=lambda: 1.0,
+        )
+
+        self.assertEqual(policy.next_delay(FAILURE_GIT_DOWNLOAD, 1, 0), 1.0)
+        self.assertEqual(policy.next_delay(FAILURE_GIT_DOWNLOAD, 2, 0), 2.0)
+        self.assertEqual(policy.next_delay(FAILURE_GIT_DOWNLOAD, 3, 0), 2.5)
+        self.assertIsNone(policy.next_delay(FAILURE_GIT_DOWNLOAD, 4, 0))
+        self.assertIsNone(policy.next_delay(FAILURE_GIT_DOWNLOAD, 1, 59.5))
+        self.assertIsNone(policy.next_delay(FAILURE_TIMEOUT, 1, 0))
+        self.assertIsNone(policy.next_delay(None, 1, 0))
+
+    def test_json_log_format(self):
+        """Ensure JSON log records carry the log context and the source"""
+
+        for item in self.test_data["ansible_pull_logs"]:
+            for line in item["log"].splitlines():
+                if line.startswith("TASK ["):
+                    self.assertEqual(
+                        get_task_name(line), line[len("TASK [") : line.index("] *")]
+                    )
+        self.assertEqual(
+            get_task_name("RUNNING HANDLER [ssh : restart] ***"), "ssh : restart"
+        )
+        self.assertIsNone(get_task_name("ok: [localhost] => TASK [x]"))
+
+        saved_context = dict(log_context)
+        self.addCleanup(set_log_context, **saved_context)
+        set_log_context(run_id="abc", attempt=2, phase="ansible", task="x : y")
+
+        formatter = JsonFormatter()
+        records = [
+            logging.makeLogRecord(
+                dict(msg="100%% of %s", args=("it",), levelname="INFO", created=1.5)
+            ),
+            logging.makeLogRecord(
+                dict(msg='"ok": true', levelname="INFO", **ansible_log_extra)
+            ),
+        ]
+        entries = [json.loads(formatter.format(record)) for record in records]
+
+        self.assertEqual(entries[0]["time"], "1970-01-01T00:00:01.500Z")
+        self.assertEqual(entries[0]["message"], "100% of it")
+        self.assertEqual(entries[0]["source"], "wrapper")
+        self.assertEqual(entries[1]["message"], '"ok": true')
+        self.assertEqual(entries[1]["source"], "ansible")
+        for entry in entries:
+            self.assertEqual(
+                [entry[key] for key in ["run_id", "attempt", "phase", "task"]],
+                ["abc", 2, "ansible", "x : y"],
+            )
+
+    def test_checkout_git_repo_failures(self):
+        """Ensure a work directory that can't be created is a download failure"""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            not_a_directory = os.path.join(tmp_dir, "file")
+            with open(not_a_directory, "w"):
+                pass
+
+            git_result = checkout_git_repo(
+                os.path.join(not_a_directory, "work"),
+                "file:///dev/null",
+                "master",
+                timeout=10,
+            )
+
+        self.assertFalse(git_result["success"])
+        self.assertEqual(get_git_failure_type({"git_result": git_result}), "download")
+
+    def test_checkout_git_repo_refs(self):
+        """Ensure branches, tags and commits check out, and others don't"""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            repo_path = os.path.join(tmp_dir, "repo")
+            repo_url = make_git_repo(repo_path)
+            commit = subprocess.check_output(
+                ["git", "-C", repo_path, "rev-parse", "HEAD"], universal_newlines=True
+            ).strip()
+            subprocess.check_call(["git", "-C", repo_path, "tag", "v1"])
+
+            git_results = {
+                ref: checkout_git_repo(
+                    os.path.join(tmp_dir, "work"), repo_url, ref, timeout=10
+                )
+                for ref in ["master", "v1", commit[:10], "missing", "0123456789"]
+            }
+
+        for ref in ["master", "v1", commit[:10]]:
+            self.assertTrue(git_results[ref]["success"], msg=ref)
+            self.assertEqual(git_results[ref]["after"], commit)
+
+        for ref in ["missing", "0123456789"]:
+            self.assertFalse(git_results[ref]["success"], msg=ref)
+            self.assertEqual(
+                get_git_failure_type({"git_result": git_results[ref]}), "checkout"
+            )
+
+    def test_enqueue_output(self):
+        """Ensure output read in chunks is split into lines and decoded safely"""
+
+        output = b"first line\nsecond \xff\xfe line\n\nlast line without newline"
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, output)
+        os.close(write_fd)
+
+        batches = queue.Queue()
+        with os.fdopen(read_fd, "rb") as out:
+            enqueue_output(out, batches, chunk_size=7)
+
+        items = [batches.get() for _ in range(batches.qsize())]
+
+        self.assertIsNone(items[-1])
+        self.assertEqual(
+            list(decode_lines(items)),
+            ["first line", "second \ufffd\ufffd line", "", "last line without newline"],
+        )
+
+    def test_resume(self):
+        """Ensure failed runs resume at the failed task until the guards apply"""
+
+        failed_task = 'hosts-file : Insert into /etc/hosts: "{{ item.line }}"'
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state", "resume-state.json")
+
+            def run(run_attempt, commit="abc", max_resumes=2):
+                state = read_resume_state(path)
+                task = get_resume_task(state, commit, "site.yaml", None, max_resumes)
+                update_resume_state(
+                    path, run_attempt, commit, "site.yaml", None, task and state
+                )
+                return task
+
+            # Failed play, then timeouts in a later task of the same commit
+            self.assertIsNone(run(self.make_attempt(1, 2)))
+            self.assertEqual(
+                run(self.make_attempt(2, None, True, last_task="x : y")), failed_task
+            )
+            self.assertEqual(
+                run(self.make_attempt(2, None, True, last_task="x : z")), "x : y"
+            )
+            self.assertIsNone(run(self.make_attempt(1, 2)))
+            self.assertEqual(read_resume_state(path)["resume_count"], 0)
+
+            # A new commit runs the whole playbook
+            self.assertIsNone(run(self.make_attempt(1, 2), commit="def"))
+            self.assertEqual(read_resume_state(path)["commit"], "def")
+
+            # A success, or a failure without a task, forgets the task
+            self.assertEqual(run(self.make_attempt(2, 0), commit="def"), failed_task)
+            self.assertIsNone(read_resume_state(path))
+            run(self.make_attempt(1, 2))
+            run(self.make_attempt(2, None, True))
+            self.assertIsNone(read_resume_state(path))
+
+    def test_merge_group_attempts(self):
+        """Ensure tag group results are merged into one result of the run"""
+
+        group_attempts = [
+            ("users", self.make_attempt(2, 0)),
+            ("monitoring", self.make_attempt(5, 2)),
+        ]
+        merged = merge_group_attempts(
+            self.make_attempt(4, 0), group_attempts, timedelta(seconds=30), 25.0
+        )
+        play_recap = merged["ansible_result"]["play_recap"]
+
+        self.assertEqual(merged["return_code"], 2)
+        self.assertFalse(merged["timed_out"])
+        self.assertEqual(classify_failure(merged), FAILURE_FAILED)
+        self.assertEqual(play_recap["ok_count"], 390 + 394 + 75)
+        self.assertEqual(play_recap["failed_count"], 1)
+        self.assertEqual(
+            merged["ansible_result"]["play_failure"]["role_and_task_names"],
+            "python3-pip : Install Python essentials (Debian/Ubuntu)",
+        )
+        self.assertEqual(
+            [
+                line.split(": [")[0]
+                for line in format_groups_summary(group_attempts).splitlines()
+            ],
+            ["Tag group [users]", "Tag group [monitoring]"],
+        )
+
+    def test_metrics(self):
+        """Ensure run metrics are written, and counters carried across runs"""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "run_ansible_pull.prom")
+
+            record_run_metrics(path, [self.make_attempt(2, 0)], 300, 0.5, 900, now=1000)
+            record_interrupt_metrics(path)
+            record_run_metrics(
+                path,
+                [self.make_attempt(1, None, True), self.make_attempt(1, 2)],
+                600,
+                1.5,
+                now=2000,
+            )
+
+            metrics = read_textfile_metrics(path)
+            self.assertEqual(os.listdir(tmp_dir), ["run_ansible_pull.prom"])
+
+        self.assertEqual(metrics[("runs_total", "")], 2)
+        self.assertEqual(metrics[("timeouts_total", "")], 1)
+        self.assertEqual(metrics[("interrupts_total", "")], 1)
+        self.assertEqual(metrics[("last_success_timestamp_seconds", "")], 1000)
+        self.assertEqual(metrics[("last_run_timestamp_seconds", "")], 2000)
+        self.assertEqual(metrics[("last_run_attempts", "")], 2)
+        self.assertEqual(metrics[("last_run_return_code", "")], 2)
+        self.assertEqual(metrics[("last_run_tasks", '{status="failed"}')], 1)
+        self.assertEqual(metrics[("last_run_git_changed", "")], 0)
+        self.assertNotIn(("last_run_git_commit_age_seconds", ""), metrics)
+
+        # Failing to write the textfile doesn't fail the run
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "missing", "run_ansible_pull.prom")
+            with self.assertLogs("run-ansible-pull", "WARNING"):
+                record_run_metrics(path, [self.make_attempt(2, 0)], 300, 0.5)
+                record_interrupt_metrics(path)
+
+    def test_sensu_deduplication(self):
+        """Ensure Sensu events are only sent on changes and heartbeats"""
+
+        log = self.test_data["ansible_pull_logs"][2]["log"]
+        summary, summary_later = [
+            format_sensu_summary(get_ansible_result(log), timedelta(seconds=s))
+            for s in [60, 90]
+        ]
+        self.assertEqual(get_summary_digest(summary), get_summary_digest(summary_later))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "state", "sensu-state.json")
+
+            with FakeSensuServer() as closed_sensu:
+                pass
+
+            def send(sensu, status, event_summary, now):
+                return send_sensu_event_on_change(
+                    status,
+                    event_summary,
+                    path,
+                    heartbeat=100,
+                    host=sensu.host,
+                    port=sensu.port,
+                    now=now,
+                )
+
+            with FakeSensuServer() as sensu:
+                send(sensu, SENSU_OK, summary, 0)
+                send(sensu, SENSU_OK, summary_later, 10)
+                send(sensu, SENSU_WARNING, summary, 20)
+                send(sensu, SENSU_WARNING, summary, 30)
+                send(sensu, SENSU_WARNING, summary, 130)
+                self.assertFalse(send(closed_sensu, SENSU_OK, summary, 140))
+                send(sensu, SENSU_OK, summary, 150)
+                send(sensu, SENSU_OK, summary + "\nKnown failures: [x]", 160)
+
+                events = sensu.wait_for_events(5)
+
+        self.assertEqual(
+            [e["status"] for e in events],
+            [SENSU_OK, SENSU_WARNING, SENSU_WARNING, SENSU_OK, SENSU_OK],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,323 @@
+import json
+import os
+import tempfile
+import unittest
+
+from run_ansible_pull.harness.runner import make_git_repo, run_wrapper
+from run_ansible_pull.sensu import SENSU_OK, SENSU_WARNING, SENSU_CRITICAL
+
+
+class RunAnsiblePullIntegrationTestCase(unittest.TestCase):
+    """Test run_ansible_pull end to end, against a fake `ansible-pull`"""
+
+    def test_success(self):
+        """Ensure a successful run sends one OK event"""
+
+        result = run_wrapper({"lines": 100})
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertEqual(len(result["ansible_commands"]), 1)
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_OK])
+
+    def test_invalid_utf8(self):
+        """Ensure output that isn't valid UTF-8 doesn't stop the output"""
+
+        result = run_wrapper({"invalid_utf8": True, "lines": 3})
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertIn("Module output: \ufffd\ufffd invalid", result["output"])
+        self.assertIn("TASK [synthetic : task 2]", result["output"])
+
+    def test_json_log_format(self):
+        """Ensure every record is logged as JSON with the context of the run"""
+
+        result = run_wrapper({"lines": 20}, wrapper_args=["--log-format", "json"])
+        entries = [json.loads(line) for line in result["output"].splitlines()]
+        ansible_entries = [e for e in entries if e["source"] == "ansible"]
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertEqual(len({e["run_id"] for e in ansible_entries}), 1)
+        self.assertEqual({e["attempt"] for e in ansible_entries}, {1})
+        self.assertEqual({e["phase"] for e in ansible_entries}, {"ansible"})
+        self.assertIn("synthetic : task 2", [e["task"] for e in ansible_entries])
+
+    def test_git_failure_retries_early(self):
+        """Ensure a Git failure is retried without waiting for Ansible to exit"""
+
+        result = run_wrapper(
+            {"git_failure": ["download"], "git_failure_hang": 60},
+            wrapper_args=["--retry-backoff", "0"],
+        )
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertEqual(len(result["ansible_commands"]), 2)
+        self.assertLess(result["latency"], 30)
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_OK])
+        self.assertIn("Attempt 1: [git_download]", result["events"][0]["output"])
+
+    def test_git_failure_output(self):
+        """Ensure output read along with a Git failure is still logged"""
+
+        result = run_wrapper(
+            {
+                "git_failure": "download",
+                "git_failure_hang": 60,
+                "log": "Could not get lock /var/lib/dpkg/lock-frontend",
+            },
+            wrapper_args=["--max-attempts", "1"],
+        )
+
+        self.assertLess(result["latency"], 30)
+        self.assertIn("Could not get lock", result["output"])
+        self.assertIn("[apt-lock-held]", result["events"][0]["output"])
+
+    def test_timeout(self):
+        """Ensure a hanging run is terminated and reported as critical"""
+
+        result = run_wrapper({"hang": 60}, wrapper_args=["--timeout", "1"])
+
+        self.assertNotEqual(result["return_code"], 0)
+        self.assertLess(result["latency"], 30)
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_CRITICAL])
+
+    def test_shutdown(self):
+        """Ensure SIGTERM stops the wrapper and its Ansible process tree"""
+
+        result = run_wrapper(
+            {"hang": 60, "children": 2}, terminate_after=1, expected_events=0
+        )
+
+        self.assertNotEqual(result["return_code"], 0)
+        self.assertLess(result["shutdown_time"], 15)
+        self.assertIsNone(result["tail_delay"])
+
+    def test_coalescing(self):
+        """Ensure triggers during a run are folded into one follow-up run"""
+
+        result = run_wrapper(
+            {"hang": 3},
+            wrapper_args=["--sensu-heartbeat", "0"],
+            triggers_after=[0.5, 0.1, 0.1],
+            expected_events=2,
+        )
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertEqual(result["trigger_return_codes"], [0, 0, 0])
+        self.assertEqual(len(result["ansible_commands"]), 2)
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_OK] * 2)
+
+    def test_sensu_deduplication(self):
+        """Ensure a run repeating the last event within the heartbeat sends none"""
+
+        result = run_wrapper({"hang": 2}, triggers_after=[0.5], expected_events=1)
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertEqual(len(result["ansible_commands"]), 2)
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_OK])
+        self.assertIn("Suppressing Sensu event", result["output"])
+
+    def test_direct(self):
+        """Ensure the direct mode checks out with Git and runs ansible-playbook"""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            git_repo_url = make_git_repo(os.path.join(tmp_dir, "repo"))
+
+            result = run_wrapper(
+                {"lines": 10}, wrapper_args=["--direct"], git_repo_url=git_repo_url
+            )
+            missing_branch = run_wrapper(
+                {"lines": 10},
+                wrapper_args=[
+                    "--direct",
+                    "--checkout",
+                    "missing",
+                    "--max-attempts",
+                    "1",
+                ],
+                git_repo_url=git_repo_url,
+            )
+            fallback = run_wrapper(
+                {"lines": 10},
+                wrapper_args=[
+                    "--direct",
+                    "--checkout",
+                    "missing",
+                    "--fallback-branch",
+                    "master",
+                    "--retry-backoff",
+                    "0",
+                ],
+                git_repo_url=git_repo_url,
+            )
+
+        self.assertEqual(result["return_code"], 0)
+        self.assertEqual(len(result["ansible_commands"]), 1)
+        self.assertEqual(result["ansible_commands"][0][-1], "playbook.yaml")
+        self.assertNotIn("--url", result["ansible_commands"][0])
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_OK])
+
+        self.assertEqual(missing_branch["ansible_commands"], [])
+        self.assertEqual(
+            [e["status"] for e in missing_branch["events"]], [SENSU_CRITICAL]
+        )
+        self.assertIn(
+            "Failed to checkout missing", missing_branch["events"][0]["output"]
+        )
+
+        self.assertEqual(len(fallback["ansible_commands"]), 1)
+        self.assertEqual([e["status"] for e in fallback["events"]], [SENSU_WARNING])
+
+    def test_resume(self):
+        """Ensure a failed run is resumed at the failed task of the same commit"""
+
+        failed_log = "\n".join(
+            [
+                "TASK [web : Install nginx] *****************************************",
+                'fatal: [localhost]: FAILED! => {"changed": false, "msg": "No nginx"}',
+                "",
+                "PLAY RECAP *********************************************************",
+                "localhost                  : ok=3    changed=0    unreachable=0    "
+                + "failed=1",
+            ]
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            git_repo_url = make_git_repo(os.path.join(tmp_dir, "repo"))
+            wrapper_args = [
+                "--direct",
+                "--resume",
+                "--resume-state-file",
+                os.path.join(tmp_dir, "resume-state.json"),
+                "--max-attempts",
+                "1",
+            ]
+
+            results = [
+                run_wrapper(
+                    scenario, wrapper_args=wrapper_args, git_repo_url=git_repo_url
+                )
+                for scenario in [
+                    {"log": failed_log, "return_code": 2},
+                    {"lines": 10},
+                    {"lines": 10},
+                ]
+            ]
+
+        commands = [result["ansible_commands"][0] for result in results]
+        self.assertNotIn("--start-at-task", commands[0])
+        self.assertIn("--start-at-task", commands[1])
+        self.assertEqual(
+            commands[1][commands[1].index("--start-at-task") + 1],
+            "web : Install nginx",
+        )
+        self.assertNotIn("--start-at-task", commands[2])
+        self.assertEqual(
+            [e["status"] for r in results for e in r["events"]],
+            [SENSU_CRITICAL, SENSU_OK, SENSU_OK],
+        )
+        self.assertIn(
+            "Resumed at task: [web : Install nginx]", results[1]["events"][0]["output"]
+        )
+
+    def test_resume_task_not_found(self):
+        """Ensure the whole playbook runs if the task to resume at is gone"""
+
+        failed_log = "\n".join(
+            [
+                "TASK [web : Install nginx] *****************************************",
+                'fatal: [localhost]: FAILED! => {"changed": false, "msg": "No nginx"}',
+                "",
+                "PLAY RECAP *********************************************************",
+                "localhost                  : ok=3    changed=0    unreachable=0    "
+                + "failed=1",
+            ]
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            git_repo_url = make_git_repo(os.path.join(tmp_dir, "repo"))
+            resume_state_file = os.path.join(tmp_dir, "resume-state.json")
+            wrapper_args = [
+                "--direct",
+                "--resume",
+                "--resume-state-file",
+                resume_state_file,
+                "--max-attempts",
+                "1",
+            ]
+
+            results = [
+                run_wrapper(
+                    scenario, wrapper_args=wrapper_args, git_repo_url=git_repo_url
+                )
+                for scenario in [
+                    {"log": failed_log, "return_code": 2},
+                    {"lines": 10, "recap": True, "start_at_task_not_found": True},
+                ]
+            ]
+            resume_state_exists = os.path.exists(resume_state_file)
+
+        commands = results[1]["ansible_commands"]
+        self.assertEqual(len(commands), 2)
+        self.assertIn("--start-at-task", commands[0])
+        self.assertNotIn("--start-at-task", commands[1])
+        self.assertFalse(resume_state_exists)
+        self.assertEqual(
+            [e["status"] for r in results for e in r["events"]],
+            [SENSU_CRITICAL, SENSU_OK],
+        )
+        self.assertIn("Task to resume at not found", results[1]["output"])
+        self.assertNotIn("Resumed at task", results[1]["events"][0]["output"])
+
+    def test_tag_groups(self):
+        """Ensure tag groups run concurrently after the prologue, in one event"""
+
+        group_args = [
+            "--prologue-tags",
+            "cache",
+            "--tag-group",
+            "monitoring",
+            "--tag-group",
+            "logs,shippers",
+            "--tag-group",
+            "users",
+            "--max-parallel",
+            "3",
+        ]
+
+        result = run_wrapper(
+            {"lines": 5, "recap": True, "hang": 2, "failed_tags": ["users"]},
+            wrapper_args=group_args + ["--max-attempts", "1"],
+        )
+        interrupted = run_wrapper(
+            {"tags_hang": {"monitoring": 60, "users": 60}},
+            wrapper_args=group_args,
+            terminate_after=2,
+            expected_events=0,
+        )
+
+        commands = result["ansible_commands"]
+        self.assertEqual(
+            ["--url" in command for command in commands], [True] + [False] * 3
+        )
+        self.assertEqual(commands[0][commands[0].index("--tags") + 1], "cache")
+        self.assertEqual(
+            sorted(command[command.index("--tags") + 1] for command in commands[1:]),
+            ["logs,shippers", "monitoring", "users"],
+        )
+        self.assertLess(result["latency"], 7)
+        self.assertIn("[monitoring] TASK [synthetic : task 1]", result["output"])
+
+        self.assertEqual([e["status"] for e in result["events"]], [SENSU_CRITICAL])
+        output = result["events"][0]["output"]
+        self.assertIn("Play failed!: [users : fail]", output)
+        self.assertIn("ok: 20, changed: 0, unreachable: 0, failed: 1", output)
+        self.assertIn("Tag group [monitoring]: [success]", output)
+        self.assertIn("Tag group [users]: [failed]", output)
+
+        self.assertEqual(len(interrupted["ansible_commands"]), 4)
+        self.assertNotEqual(interrupted["return_code"], 0)
+        self.assertLess(interrupted["shutdown_time"], 15)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,7 +8,10 @@ setup(
     description='Runs Ansible Pull and reports to Sensu',
     author='Neil Hooey',
     author_email='nhooey@gmail.com',
-    packages=['run_ansible_pull'],
+    packages=['run_ansible_pull', 'run_ansible_pull.harness'],
+    package_data={
+        'run_ansible_pull': ['failure_rules.yaml'],
+    },
     entry_points={
         'console_scripts': [
             'run-ansible-pull = run_ansible_pull.main:run',